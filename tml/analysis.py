@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    Connected regions of the gamelayer.
+
+    :copyright: 2010-2011 by the TML Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+from bisect import bisect_right
+import re
+
+from constants import TILEINDEX
+
+KINDS = ('air', 'solid', 'death', 'nohook')
+
+# maps tile indices to their kind, entities and unknown indices are air
+_KIND_TABLE = ''.join([chr(i) if i < len(KINDS) else '\x00'
+                       for i in xrange(256)])
+_RUN = re.compile('\x00+|\x01+|\x02+|\x03+')
+_SPAWNS = re.compile('[{0}]'.format(''.join([chr(TILEINDEX[name]) for name
+                                   in ('spawn', 'spawn_red', 'spawn_blue')])))
+
+class Region(object):
+    """A connected area of tiles of the same kind.
+
+    Tiles are connected to the tiles left, right, above and below them.
+
+    :param id: Position of the region in its :class:`RegionMap`.
+    :param kind: One of :data:`KINDS`.
+
+    """
+
+    def __init__(self, id, kind):
+        self.id = id
+        self.kind = kind
+        self.size = 0
+        self.x1 = self.y1 = None
+        self.x2 = self.y2 = None
+        # ids of the regions touching this one
+        self.neighbours = set()
+        # positions of the spawns in the region
+        self.spawns = []
+        self.touches_border = False
+
+    @property
+    def bbox(self):
+        """``(x, y, width, height)`` of the region."""
+        return (self.x1, self.y1, self.x2 - self.x1 + 1,
+                self.y2 - self.y1 + 1)
+
+    def __repr__(self):
+        return '<Region {0} ({1}, {2} tiles)>'.format(self.id, self.kind,
+                                                      self.size)
+
+class RegionMap(object):
+    """Labels the connected regions of air, solid, death and nohook tiles.
+
+    Entities are air. The rows of the layer are split into runs of the
+    same kind, which are joined with the overlapping runs of the row above
+    by union-find, so the work grows with the number of runs, not of
+    tiles.
+
+    :param layer: The gamelayer, a :class:`TileLayer <tml.items.TileLayer>`
+
+    """
+
+    def __init__(self, layer):
+        self.width = width = layer.width
+        self.height = height = layer.height
+        indices = str(layer.tiles.data[0::4])
+        kinds = indices.translate(_KIND_TABLE)
+
+        parent = []
+        runs = []
+        # runs of different kinds next to each other
+        pairs = []
+        # run starts and run numbers per row, to find the run of a tile
+        self._rows = []
+        previous = []
+        for y in xrange(height):
+            row = kinds[y*width:(y+1)*width]
+            current = []
+            for match in _RUN.finditer(row):
+                run = len(parent)
+                parent.append(run)
+                start, end = match.span()
+                runs.append((y, start, end, ord(row[start])))
+                if current:
+                    pairs.append((current[-1][3], run))
+                current.append((start, end, ord(row[start]), run))
+
+            # join the runs with the overlapping runs of the row above
+            i = j = 0
+            while i < len(previous) and j < len(current):
+                start, end, kind, run = previous[i]
+                start2, end2, kind2, run2 = current[j]
+                if start < end2 and start2 < end:
+                    if kind == kind2:
+                        root = self._find(parent, run)
+                        root2 = self._find(parent, run2)
+                        # the oldest run stays the root, so regions are
+                        # numbered by their first tile
+                        if root < root2:
+                            parent[root2] = root
+                        elif root2 < root:
+                            parent[root] = root2
+                    else:
+                        pairs.append((run, run2))
+                if end <= end2:
+                    i += 1
+                else:
+                    j += 1
+            self._rows.append(([start for start, _, _, _ in current],
+                               [run for _, _, _, run in current]))
+            previous = current
+
+        self.regions = []
+        roots = {}
+        labels = []
+        for run, (y, start, end, kind) in enumerate(runs):
+            root = self._find(parent, run)
+            if root not in roots:
+                roots[root] = len(self.regions)
+                self.regions.append(Region(len(self.regions), KINDS[kind]))
+            labels.append(roots[root])
+            region = self.regions[roots[root]]
+            region.size += end - start
+            if region.x1 is None:
+                region.x1, region.y1 = start, y
+                region.x2, region.y2 = end - 1, y
+            else:
+                region.x1 = min(region.x1, start)
+                region.x2 = max(region.x2, end - 1)
+                region.y2 = y
+        # from now on the rows point to the regions instead of the runs
+        for starts, row_runs in self._rows:
+            row_runs[:] = [labels[run] for run in row_runs]
+
+        for run, run2 in pairs:
+            self.regions[labels[run]].neighbours.add(labels[run2])
+            self.regions[labels[run2]].neighbours.add(labels[run])
+        for region in self.regions:
+            region.touches_border = region.x1 == 0 or region.y1 == 0 or \
+                region.x2 == width - 1 or region.y2 == height - 1
+        for match in _SPAWNS.finditer(indices):
+            y, x = divmod(match.start(), width)
+            self.region_at(x, y).spawns.append((x, y))
+
+    @staticmethod
+    def _find(parent, run):
+        while parent[run] != run:
+            parent[run] = parent[parent[run]]
+            run = parent[run]
+        return run
+
+    def region_at(self, x, y):
+        """Returns the region of the tile at the given coordinates."""
+        if not 0 <= x < self.width:
+            raise ValueError('x is out of bounds')
+        if not 0 <= y < self.height:
+            raise ValueError('y is out of bounds')
+        starts, regions = self._rows[y]
+        return self.regions[regions[bisect_right(starts, x) - 1]]
+
+    def by_kind(self, kind):
+        """Returns all regions of a kind in :data:`KINDS`."""
+        return [region for region in self.regions if region.kind == kind]
+
+    def spawn_regions(self):
+        """Returns the air regions with spawns in them."""
+        return [region for region in self.regions if region.spawns]
+
+    def pockets(self):
+        """Returns the air regions without spawns, largest first.
+
+        Tees can't get into them, unless they are teleported.
+
+        """
+        pockets = [region for region in self.by_kind('air')
+                   if not region.spawns]
+        return sorted(pockets, key=lambda region: -region.size)
+
+    def __getitem__(self, id):
+        return self.regions[id]
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __repr__(self):
+        return '<RegionMap ({0} regions)>'.format(len(self.regions))
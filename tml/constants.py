@@ -43,3 +43,16 @@ TILEINDEX  = {
     'ninja': 201,
     'rifle': 202,
 }
+
+# zlib settings of the compression profiles for saving maps, as
+# (level, memory level) for small and for large data parts. Small data
+# parts always use the default settings, the profiles only differ for large
+# ones. All of them produce plain zlib streams, which every client can load.
+COMPRESSION_PROFILES = {
+    'fast': ((6, 8), (1, 8)),
+    'default': ((6, 8), (6, 8)),
+    'max': ((6, 8), (9, 9)),
+}
+# data parts up to this size are cheap to compress and use the settings for
+# small data parts
+COMPRESSION_SMALL_SIZE = 16384
@@ -1,30 +1,37 @@
 # -*- coding: utf-8 -*-
-from struct import pack, unpack
-from zlib import compress, decompress
+from io import BytesIO
+import mmap
+from multiprocessing.pool import ThreadPool
+import shutil
+import stat
+import tempfile
+from struct import pack, unpack, unpack_from
+import weakref
+from zlib import DEFLATED, MAX_WBITS, compressobj, crc32, decompress
 
 from constants import *
 import items
-from utils import ints_to_string, string_to_ints
+import schemas
+from utils import data_key, int32
 
 class Header(object):
     """Contains fileheader information.
 
-    Please make sure the passed file is at the beginning.
-    Note that the file won't be rewinded!
-
-    :param f: The file with the information.
+    :param data: The mapped file or a string with its content.
     """
 
-    def __init__(self, f=None):
+    def __init__(self, data=None):
         self.version = 4
         self.size = 0
-        if f != None:
-            sig = ''.join(unpack('4c', f.read(4)))
+        if data is not None:
+            if len(data) < 36:
+                raise TypeError('Invalid file')
+            sig = data[:4]
             if sig not in ('DATA', 'ATAD'):
                 raise TypeError('Invalid signature')
             self.version, self.size_, self.swaplen, self.num_item_types, \
             self.num_items, self.num_raw_data, self.item_size, \
-            self.data_size = unpack('8i', f.read(32))
+            self.data_size = unpack_from('8i', data, 4)
             if self.version != 4:
                 raise TypeError('Wrong version')
 
@@ -35,227 +42,477 @@ class Header(object):
                 (self.num_items + (2 * self.num_raw_data)) * 4 # item offsets, data offsets, uncompressed data sizes
             ])
 
+def _decode_tiles(data):
+    return items.TileManager(data=data)
+
+def _decode_tele_tiles(data):
+    return items.TeleTileManager(data=data)
+
+def _decode_speedup_tiles(data):
+    return items.SpeedupTileManager(data=data)
+
+def _decode_quads(data):
+    return items.QuadManager(data=[data[i:i+152] for i in xrange(0, len(data), 152)])
+
+def _decode_raw(data):
+    return data
+
+def _encode_tiles(tiles):
+    return tiles.data
+
+def _encode_quads(quads):
+    return ''.join(quads.quads)
+
+def _raw_data(obj, name, encode):
+    """Returns the raw data of a lazy attribute for the writer.
+
+    If the attribute was not loaded yet, the :class:`LazyData
+    <tml.items.LazyData>` is returned to pass the compressed data through.
+    """
+    value = items.peek(obj, name)
+    if isinstance(value, items.LazyData):
+        return value
+    return encode(getattr(obj, name))
+
+def _compress(args):
+    """Compresses the data with the given zlib level and memory level.
+
+    :param args: Tuple of the data and a tuple of the settings.
+    """
+    data, (level, memlevel) = args
+    compressor = compressobj(level, DEFLATED, MAX_WBITS, memlevel)
+    return compressor.compress(data) + compressor.flush()
+
+def _replace_file(src, dest):
+    """Moves `src` to `dest`, replacing `dest` if it exists."""
+    try:
+        os.rename(src, dest)
+    except OSError:
+        # windows does not replace existing files
+        os.remove(dest)
+        os.rename(src, dest)
+
+# mode of new map files. The umask can only be read by changing it, which
+# is done once on import, before the program starts other threads, instead
+# of on every save.
+_umask = os.umask(0)
+os.umask(_umask)
+_NEW_FILE_MODE = 0666 & ~_umask
+del _umask
+
+# the mappings of the files by their real path
+_mappings = {}
+
+class _MappedFile(mmap.mmap):
+    """A memory-mapped file, registered by its path until it is closed."""
+
+    def close(self):
+        mappings = _mappings.get(self.path)
+        if mappings is not None:
+            mappings.discard(self)
+        super(_MappedFile, self).close()
+
+def _map_file(f):
+    """Maps the file `f` from its current position into memory.
+
+    If the file can't be mapped, it is read instead.
+
+    :returns: tuple of the data and the mapping, which is ``None`` if the
+              file was read.
+    """
+    try:
+        position = f.tell()
+        mapping = _MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        # empty files, streams and some special files can't be mapped
+        return f.read(), None
+    mapping.path = None
+    name = getattr(f, 'name', None)
+    if isinstance(name, basestring):
+        mapping.path = os.path.realpath(name)
+        _mappings.setdefault(mapping.path, weakref.WeakSet()).add(mapping)
+    if position:
+        return buffer(mapping, position), mapping
+    return mapping, mapping
+
 class DataFileReader(object):
+    """Reads a teeworlds datafile.
+
+    The file is memory-mapped, items and compressed data parts are only
+    handed out as buffers of the mapped file instead of being copied.
+
+    :param map_path: Path to the mapfile, the extension is optional. Can
+                     also be a file-like object, which is mapped if
+                     possible and read otherwise.
+    :param lazy: If ``True``, tiles, quads and embedded images are only
+                 decompressed when they are accessed for the first time.
+    :param load_items: If ``False``, only the header is parsed. Use it
+                       together with :meth:`metadata`.
+    :param workers: Number of threads decompressing the tile, quad and image
+                    data in parallel. Ignored if the reader is lazy.
+    :param data: Content of a mapfile as string, bytearray, buffer or mmap,
+                 used instead of `map_path`.
+
+    The reader can be used as context manager, which closes the mapped file
+    at the end, see :meth:`close`.
+    """
 
-    def __init__(self, map_path):
+    def __init__(self, map_path=None, lazy=False, load_items=True, workers=1,
+                 data=None):
+        self.lazy = lazy
+        self.workers = workers
+        self._decompressed = {}
+        # compressed data parts by the key of their decompressed content
+        self.blocks = {}
+        # items of unknown types by type and id and the data parts only
+        # they can reference by index
+        self.unknown_items = {}
+        self.unknown_datas = {}
         # default list of item types
         for type_ in ITEM_TYPES:
             if type_ != 'version' and type_ != 'layer':
                 setattr(self, ''.join([type_, 's']), [])
 
-        path, filename = os.path.split(map_path)
-        self.name, extension = os.path.splitext(filename)
-        if extension == '':
-            self.map_path = os.extsep.join([map_path, 'map'])
-        elif extension != ''.join([os.extsep, 'map']):
-            raise TypeError('Invalid file')
+        self.name = ''
+        self.map_path = None
+        self._mapping = None
+        if data is not None:
+            if isinstance(data, memoryview):
+                # memoryviews don't support the old buffer interface
+                data = data.tobytes()
+            self.data = data
+        elif hasattr(map_path, 'read'):
+            self.data, self._mapping = _map_file(map_path)
         else:
-            self.map_path = map_path
-
-        with open(self.map_path, 'rb') as f:
-            self.f = f
-            self.header = Header(f)
-            self.item_types = []
-            for i in range(self.header.num_item_types):
-                val = unpack('3i', f.read(12))
-                self.item_types.append({
-                    'type': val[0],
-                    'start': val[1],
-                    'num': val[2],
-                })
-            fmt = '{0}i'.format(self.header.num_items)
-            self.item_offsets = unpack(fmt, f.read(self.header.num_items * 4))
-            fmt = '{0}i'.format(self.header.num_raw_data)
-            self.data_offsets = unpack(fmt, f.read(self.header.num_raw_data * 4))
-
-            # check version
-            item_size, version_item = self.find_item(f, ITEM_VERSION, 0)
-            fmt = '{0}i'.format(item_size/4)
-            version = unpack(fmt, version_item)[0] # we only expect 1 element here
-            if version != 1:
-                raise ValueError('Wrong version')
-
-            # load items
-            # begin with map info
-            item = self.find_item(f, ITEM_INFO, 0)
-            if item is not None:
-                item_size, item_data = item
-                fmt = '{0}i'.format(item_size/4)
-                version, author, map_version, credits, license, \
-                settings = item_data[:items.Info.type_size]
-                if author > -1:
-                    author = decompress(self.get_compressed_data(f, author))[:-1]
-                if map_version > -1:
-                    map_version = decompress(self.get_compressed_data(f, map_version))[:-1]
-                if credits > -1:
-                    credits = decompress(self.get_compressed_data(f, credits))[:-1]
-                if license > -1:
-                    license = decompress(self.get_compressed_data(f, licsense))[:-1]
-                if settings > -1:
-                    settings = decompress(self.get_compressed_data(f, settings)).split('\x00')[:-1]
-                self.info = items.Info(author=author, map_version=map_version,
-                                       credits=credits, license=license,
-                                       settings=settings)
+            path, filename = os.path.split(map_path)
+            self.name, extension = os.path.splitext(filename)
+            if extension == '':
+                self.map_path = os.extsep.join([map_path, 'map'])
+            elif extension != ''.join([os.extsep, 'map']):
+                raise TypeError('Invalid file')
             else:
-                self.info = None
-
-            # load images
-            start, num = self.get_item_type(ITEM_IMAGE)
-            for i in range(num):
-                item = self.get_item(f, start+i)
-                item_size, item_data = item
-                fmt = '{0}i'.format(item_size/4)
-                item_data = unpack(fmt, item_data)
-                version, width, height, external, image_name, \
-                image_data = item_data[:items.Image.type_size]
-                external = bool(external)
-                name = decompress(self.get_compressed_data(f, image_name))[:-1]
-                data = decompress(self.get_compressed_data(f, image_data)) if not external else None
-                image = items.Image(external=external, name=name,
-                                   data=data, width=width, height=height)
-                self.images.append(image)
-
-            # load groups
-            group_item_start, group_item_num = self.get_item_type(ITEM_GROUP)
-            for i in range(group_item_num):
-                item_size, item_data = self.get_item(f, group_item_start+i)
-                fmt = '{0}i'.format(item_size/4)
-                item_data = unpack(fmt, item_data)
-                version, offset_x, offset_y, parallax_x, parallax_y, \
-                start_layer, num_layers, use_clipping, clip_x, clip_y, \
-                clip_w, clip_h = item_data[:items.Group.type_size-3]
-                if version >= 3:
-                    data = item_data[items.Group.type_size-3:items.Group.type_size]
-                    group_name = ints_to_string(data) or None
-                else:
-                    group_name = None
-                start_layer, num_layers = item_data[5:7]
-
-                # load layers in group
-                layer_item_start, layer_item_num = self.get_item_type(ITEM_LAYER)
-                layers = []
-                for j in range(num_layers):
-                    item_size, item_data = self.get_item(f, layer_item_start+start_layer+j)
-                    fmt = '{0}i'.format(item_size/4)
-                    item_data = unpack(fmt, item_data)
-                    layer_version, type_, flags = item_data[:items.Layer.type_size]
-                    detail = True if flags else False
-
-                    if type_ == LAYERTYPE_TILES:
-                        type_size = items.TileLayer.type_size
-                        color = 4*[0]
-                        version, width, height, game, color[0], color[1], \
-                        color[2], color[3], color_env, color_env_offset, \
-                        image_id, data = item_data[3:type_size-3]
-                        name = None
-                        if version >= 3:
-                            name = ints_to_string(item_data[type_size-3:type_size]) or None
-                        tile_list = []
-                        tile_data = decompress(self.get_compressed_data(f, data))
-                        for i in xrange(0, len(tile_data), 4):
-                            tile_list.append(tile_data[i:i+4])
-                        tiles = items.TileManager(data=tile_list)
-                        tele_tiles = None
-                        speedup_tiles = None
-                        if game == 2:
-                            tele_list = []
-                            if version >= 3:
-                                # num of tele data is right after the default type length
-                                if len(item_data) > items.TileLayer.type_size: # some security
-                                    tele_data = item_data[items.TileLayer.type_size]
-                                    if tele_data > -1 and tele_data < self.header.num_raw_data:
-                                        tele_data = decompress(self.get_compressed_data(f, tele_data))
-                                        for i in xrange(0, len(tele_data), 2):
-                                            tele_list.append(tele_data[i:i+2])
-                                        tele_tiles = items.TileManager(data=tele_list, _type=1)
-                            else:
-                                # num of tele data is right after num of data for old maps
-                                if len(item_data) > items.TileLayer.type_size-3: # some security
-                                    tele_data = item_data[items.TileLayer.type_size-3]
-                                    if tele_data > -1 and tele_data < self.header.num_raw_data:
-                                        tele_data = decompress(self.get_compressed_data(f, tele_data))
-                                        for i in xrange(0, len(tele_data), 2):
-                                            tele_list.append(tele_data[i:i+2])
-                                        tele_tiles = items.TileManager(data=tele_list, _type=1)
-                        elif game == 4:
-                            speedup_list = []
-                            if version >= 3:
-                                # num of speedup data is right after tele data
-                                if len(item_data) > items.TileLayer.type_size+1: # some security
-                                    speedup_data = item_data[items.TileLayer.type_size+1]
-                                    if speedup_data > -1 and speedup_data < self.header.num_raw_data:
-                                        speedup_data = decompress(self.get_compressed_data(f, speedup_data))
-                                        for i in xrange(0, len(speedup_data), 4):
-                                            speedup_list.append(speedup_data[i:i+4])
-                                        speedup_tiles = items.TileManager(data=speedup_list, _type=2)
-                            else:
-                                # num of speedup data is right after tele data
-                                if len(item_data) > items.TileLayer.type_size-2: # some security
-                                    speedup_data = item_data[items.TileLayer.type_size-2]
-                                    if speedup_data > -1 and speedup_data < self.header.num_raw_data:
-                                        speedup_data = decompress(self.get_compressed_data(f, speedup_data))
-                                        for i in xrange(0, len(speedup_data), 4):
-                                            speedup_list.append(speedup_data[i:i+4])
-                                        speedup_tiles = items.TileManager(data=speedup_list, _type=2)
-                        layer = items.TileLayer(width=width, height=height,
-                                                name=name, detail=detail, game=game,
-                                                color=tuple(color), color_env=color_env,
-                                                color_env_offset=color_env_offset,
-                                                image_id=image_id, tiles=tiles,
-                                                tele_tiles=tele_tiles,
-                                                speedup_tiles=speedup_tiles)
-                        layers.append(layer)
-                    elif type_ == LAYERTYPE_QUADS:
-                        type_size = items.QuadLayer.type_size
-                        version, num_quads, data, image_id = item_data[3:type_size-3]
-                        name = None
-                        if version >= 2:
-                            name = ints_to_string(item_data[type_size-3:type_size]) or None
-                        quad_data = decompress(self.get_compressed_data(f, data))
-                        quad_list = []
-                        for k in xrange(0, len(quad_data), 152):
-                            quad_list.append(quad_data[k:k+152])
-                        quads = items.QuadManager(data=quad_list)
-                        layer = items.QuadLayer(name=name, detail=detail,
-                                                image_id=image_id, quads=quads)
-                        layers.append(layer)
-
-                group = items.Group(name=group_name, offset_x=offset_x,
-                                    offset_y=offset_y, parallax_x=parallax_x,
-                                    parallax_y=parallax_y,
-                                    use_clipping=use_clipping, clip_x=clip_x,
-                                    clip_y=clip_y, clip_w=clip_w,
-                                    clip_h=clip_h, layers=layers)
-                self.groups.append(group)
-
-            # load envpoints
-            item_size, item = self.find_item(f, ITEM_ENVPOINT, 0)
-            fmt = '{0}i'.format(item_size/4)
-            item = unpack(fmt, item)
-            type_size = items.Envpoint.type_size
-            for i in range(len(item)/6):
-                point = list(item[(i*6):(i*6+6)])
-                time, curvetype = point[:type_size-4]
-                values = point[type_size-4:type_size]
-                envpoint = items.Envpoint(time=time, curvetype=curvetype,
-                                          values=values)
-                self.envpoints.append(envpoint)
-
-            # load envelopes
-            start, num = self.get_item_type(ITEM_ENVELOPE)
-            type_size = items.Envelope.type_size
-            for i in range(num):
-                item_size, item_data = self.get_item(f, start+i)
-                fmt = '{0}i'.format(item_size/4)
-                item_data = unpack(fmt, item_data)
-                version, channels, start_point, \
-                num_point = item_data[:type_size-8]
-                name = ints_to_string(item_data[type_size-8:type_size])
-                envpoints = self.envpoints[start_point:start_point+num_point]
-                envelope = items.Envelope(name=name, version=version,
-                                          channels=channels,
-                                          envpoints=envpoints)
-                self.envelopes.append(envelope)
+                self.map_path = map_path
+
+            with open(self.map_path, 'rb') as f:
+                self.data, self._mapping = _map_file(f)
+        self._load(load_items)
+
+    def close(self):
+        """Closes the mapped file.
+
+        Items and data parts handed out as buffers of the file can't be
+        read anymore afterwards. :meth:`Teemap.close
+        <tml.tml.Teemap.close>` copies the ones of a map first.
+        """
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load(self, load_items=True):
+        """Parses the header and loads the items."""
+        self.header = Header(self.data)
+        offset = 36
+        fmt = '{0}i'.format(self.header.num_item_types * 3)
+        val = unpack_from(fmt, self.data, offset)
+        self.item_types = []
+        for i in range(self.header.num_item_types):
+            self.item_types.append({
+                'type': val[i*3],
+                'start': val[i*3+1],
+                'num': val[i*3+2],
+            })
+        offset += self.header.num_item_types * 12
+        fmt = '{0}i'.format(self.header.num_items)
+        self.item_offsets = unpack_from(fmt, self.data, offset)
+        offset += self.header.num_items * 4
+        fmt = '{0}i'.format(self.header.num_raw_data)
+        self.data_offsets = unpack_from(fmt, self.data, offset)
+        offset += self.header.num_raw_data * 4
+        self.data_sizes = unpack_from(fmt, self.data, offset)
+
+        # check version
+        item_size, version_item = self.find_item(ITEM_VERSION, 0)
+        version = schemas.VERSION.decode(version_item, item_size)['version']
+        if version != 1:
+            raise ValueError('Wrong version')
+
+        if load_items:
+            self._load_items()
+
+    def _load_items(self):
+        """Loads all items of the map."""
+        if not self.lazy and self.workers > 1:
+            self._decompress_all(self._data_indices())
+
+        # begin with map info
+        self.info = self._load_info()
+        self._load_unknown()
+
+        # load images
+        start, num = self.get_item_type(ITEM_IMAGE)
+        for i in range(num):
+            item = self._decode_item(schemas.IMAGE, start+i)
+            external = bool(item['external'])
+            name = self._decompress(item['name'])[:-1]
+            data = None
+            if not external:
+                data = self.get_data(item['data'], _decode_raw)
+            image = items.Image(external=external, name=name, data=data,
+                                width=item['width'], height=item['height'])
+            self.images.append(image)
+
+        # load groups
+        group_item_start, group_item_num = self.get_item_type(ITEM_GROUP)
+        layer_item_start, layer_item_num = self.get_item_type(ITEM_LAYER)
+        for i in range(group_item_num):
+            group = self._decode_item(schemas.GROUP, group_item_start+i)
+
+            # load layers in group
+            layers = []
+            for j in range(group['num_layers']):
+                item_size, item_data = self.get_item(
+                    layer_item_start+group['start_layer']+j)
+                type_ = schemas.LAYER.decode(item_data, 12)['type']
+                if type_ == LAYERTYPE_TILES:
+                    item = schemas.TILELAYER.decode(item_data, item_size)
+                    tiles = self.get_data(item['data'], _decode_tiles)
+                    tele_tiles = None
+                    speedup_tiles = None
+                    # the number of the tele and speedup data is right
+                    # after the known fields
+                    if item['game'] == 2:
+                        tele_tiles = self._get_extra_data(item['extra'], 0,
+                                                          _decode_tele_tiles)
+                    elif item['game'] == 4:
+                        speedup_tiles = self._get_extra_data(item['extra'], 1,
+                                                    _decode_speedup_tiles)
+                    layer = items.TileLayer(width=item['width'],
+                                height=item['height'], name=item['name'] or None,
+                                detail=bool(item['flags']), game=item['game'],
+                                color=tuple(item['color']),
+                                color_env=item['color_env'],
+                                color_env_offset=item['color_env_offset'],
+                                image_id=item['image_id'], tiles=tiles,
+                                tele_tiles=tele_tiles,
+                                speedup_tiles=speedup_tiles)
+                    # e.g. data of layers of modifications
+                    layer.extra = tuple(item['extra'][2:])
+                    layers.append(layer)
+                elif type_ == LAYERTYPE_QUADS:
+                    item = schemas.QUADLAYER.decode(item_data, item_size)
+                    quads = self.get_data(item['data'], _decode_quads)
+                    layer = items.QuadLayer(name=item['name'] or None,
+                                            detail=bool(item['flags']),
+                                            image_id=item['image_id'],
+                                            quads=quads)
+                    layer.extra = tuple(item['extra'])
+                    layers.append(layer)
+
+            group = items.Group(name=group['name'] or None,
+                                offset_x=group['offset_x'],
+                                offset_y=group['offset_y'],
+                                parallax_x=group['parallax_x'],
+                                parallax_y=group['parallax_y'],
+                                use_clipping=group['use_clipping'],
+                                clip_x=group['clip_x'], clip_y=group['clip_y'],
+                                clip_w=group['clip_w'], clip_h=group['clip_h'],
+                                layers=layers)
+            self.groups.append(group)
+
+        # load envpoints
+        item_size, item_data = self.find_item(ITEM_ENVPOINT, 0)
+        for point in schemas.ENVPOINT.iter_decode(item_data, item_size):
+            envpoint = items.Envpoint(time=point['time'],
+                                      curvetype=point['curvetype'],
+                                      values=list(point['values']))
+            self.envpoints.append(envpoint)
+
+        # load envelopes
+        start, num = self.get_item_type(ITEM_ENVELOPE)
+        for i in range(num):
+            item = self._decode_item(schemas.ENVELOPE, start+i)
+            start_point = item['start_point']
+            envpoints = self.envpoints[start_point:
+                                       start_point+item['num_points']]
+            envelope = items.Envelope(name=item['name'],
+                                      version=item['version'],
+                                      channels=item['channels'],
+                                      envpoints=envpoints)
+            self.envelopes.append(envelope)
+
+    def _load_info(self):
+        """Returns the map info or ``None`` if the map has none."""
+        item = self.find_item(ITEM_INFO, 0)
+        if item is None:
+            return None
+        item_size, item_data = item
+        item = schemas.INFO.decode(item_data, item_size)
+        strings = []
+        for name in ('author', 'map_version', 'credits', 'license'):
+            index = item[name]
+            if index is not None and -1 < index < self.header.num_raw_data:
+                strings.append(self._decompress(index)[:-1])
+            else:
+                strings.append(None)
+        author, map_version, credits, license = strings
+        settings = item['settings']
+        if -1 < settings < self.header.num_raw_data:
+            settings = self._decompress(settings).split('\x00')[:-1]
+        else:
+            settings = None
+        return items.Info(author=author, map_version=map_version,
+                          credits=credits, license=license, settings=settings)
+
+    def metadata(self):
+        """Returns the most important information about the map.
+
+        Only the map info, image names and the layer and group items are
+        read, no tiles, quads or image data are decompressed.
+
+        :returns: dict with the keys ``name``, ``author``, ``map_version``,
+                  ``credits``, ``license``, ``num_groups``, ``num_layers``,
+                  ``width``, ``height`` (of the gamelayer, ``None`` if
+                  there is none) and ``images``, a list of dicts with the
+                  keys ``name``, ``external``, ``width`` and ``height``.
+        """
+        info = self._load_info() or items.Info()
+        images = []
+        start, num = self.get_item_type(ITEM_IMAGE)
+        for i in range(num):
+            item = self._decode_item(schemas.IMAGE, start+i)
+            name = decompress(self.get_compressed_data(item['name']))[:-1]
+            images.append({
+                'name': name,
+                'external': bool(item['external']),
+                'width': item['width'],
+                'height': item['height'],
+            })
+        width = height = None
+        start, num_layers = self.get_item_type(ITEM_LAYER)
+        for i in range(num_layers):
+            item = self._decode_item(schemas.TILELAYER, start+i)
+            if item['type'] == LAYERTYPE_TILES and item['game'] == 1:
+                width, height = item['width'], item['height']
+                break
+        return {
+            'name': self.name,
+            'author': info.author,
+            'map_version': info.map_version,
+            'credits': info.credits,
+            'license': info.license,
+            'num_groups': self.get_item_type(ITEM_GROUP)[1],
+            'num_layers': num_layers,
+            'width': width,
+            'height': height,
+            'images': images,
+        }
+
+    def fingerprint(self):
+        """Returns the fingerprint of the map without loading it.
+
+        It is the same as :meth:`Teemap.fingerprint
+        <tml.tml.Teemap.fingerprint>` of the loaded map, but computed from
+        the items of the file. No items objects are built, the data parts
+        are decompressed one after another while they are hashed and are
+        not decoded.
+        """
+        info = self._load_info() or items.Info()
+        values = [(info.author, info.map_version, info.credits, info.license,
+                   tuple(info.settings or ()))]
+        datas = []
+        start, num = self.get_item_type(ITEM_IMAGE)
+        for i in range(num):
+            item = self._decode_item(schemas.IMAGE, start+i)
+            name = decompress(self.get_compressed_data(item['name']))[:-1]
+            values.append((name, item['width'], item['height'],
+                           bool(item['external'])))
+            datas.append(None if item['external'] else item['data'])
+        item = self.find_item(ITEM_ENVPOINT, 0)
+        envpoints = []
+        if item is not None:
+            envpoints = list(schemas.ENVPOINT.iter_decode(item[1], item[0]))
+        start, num = self.get_item_type(ITEM_ENVELOPE)
+        for i in range(num):
+            item = self._decode_item(schemas.ENVELOPE, start+i)
+            points = slice(item['start_point'],
+                           item['start_point']+item['num_points'])
+            values.append((item['name'] or '', item['channels'],
+                           len(xrange(*points.indices(len(envpoints))))))
+        for point in envpoints:
+            values.append((point['time'], point['curvetype'],
+                           tuple(point['values'])))
+        group_start, num_groups = self.get_item_type(ITEM_GROUP)
+        layer_start = self.get_item_type(ITEM_LAYER)[0]
+        for i in range(num_groups):
+            group = self._decode_item(schemas.GROUP, group_start+i)
+            layers = []
+            for j in range(group['num_layers']):
+                layer = self._layer_fingerprint(
+                    layer_start+group['start_layer']+j)
+                if layer is not None:
+                    layers.append(layer)
+            values.append((group['name'] or '', group['offset_x'],
+                           group['offset_y'], group['parallax_x'],
+                           group['parallax_y'], group['use_clipping'],
+                           group['clip_x'], group['clip_y'], group['clip_w'],
+                           group['clip_h'], layers))
+        self._load_unknown()
+        for key, data in sorted(self.unknown_items.items()):
+            values.append((key, data))
+        for index in sorted(self.unknown_datas):
+            # empty data parts only fill gaps before reserved indices
+            if self.data_sizes[index]:
+                values.append(index)
+                datas.append(index)
+        return items.fingerprint(values, self._iter_raw_datas(datas))
+
+    def _layer_fingerprint(self, index):
+        """Returns the fingerprint of a layer item like
+        :meth:`TileLayer.fingerprint <tml.items.TileLayer.fingerprint>`,
+        ``None`` for layers of unknown types."""
+        item_size, item_data = self.get_item(index)
+        type_ = schemas.LAYER.decode(item_data, 12)['type']
+        if type_ == LAYERTYPE_TILES:
+            item = schemas.TILELAYER.decode(item_data, item_size)
+            extra = item['extra']
+            values = ('tiles', item['name'] or '', bool(item['flags']),
+                      item['width'], item['height'], item['game'],
+                      tuple(item['color']), item['color_env'],
+                      item['color_env_offset'], item['image_id'],
+                      tuple(extra[2:]))
+            datas = [item['data'], None, None]
+            # layers without tele or speedup data get empty ones
+            size = item['width'] * item['height']
+            if item['game'] == 2:
+                datas[1] = '\x00' * (size*items.TeleTileManager.record.size)
+                if len(extra) > 0 and -1 < extra[0] < self.header.num_raw_data:
+                    datas[1] = extra[0]
+            elif item['game'] == 4:
+                datas[2] = '\x00' * (size*items.SpeedupTileManager.record.size)
+                if len(extra) > 1 and -1 < extra[1] < self.header.num_raw_data:
+                    datas[2] = extra[1]
+        elif type_ == LAYERTYPE_QUADS:
+            item = schemas.QUADLAYER.decode(item_data, item_size)
+            values = ('quads', item['name'] or '', bool(item['flags']),
+                      item['image_id'], tuple(item['extra']))
+            datas = [item['data']]
+        else:
+            return None
+        return items.fingerprint(values, self._iter_raw_datas(datas))
+
+    def _iter_raw_datas(self, datas):
+        """Decompresses the data parts given by index one after another,
+        strings and ``None`` are passed through."""
+        for data in datas:
+            if isinstance(data, (int, long)):
+                data = decompress(self.get_compressed_data(data))
+            yield data
 
     def get_item_type(self, item_type):
         """Returns the index of the first item and the number of items for the type."""
@@ -270,24 +527,29 @@ class DataFileReader(object):
             return (self.header.item_size - self.item_offsets[index]) - 8   # -8 to cut out type_and_id and size
         return (self.item_offsets[index+1] - self.item_offsets[index]) - 8
 
-    def get_item(self, f, index):
-        """Returns the item from the file."""
+    def get_item(self, index):
+        """Returns the size of the item and a buffer with its data."""
         if index < self.header.num_items:
-            f.seek(self.header.size + self.item_offsets[index] + 8) # +8 to cut out type_and_id and size
+            offset = self.header.size + self.item_offsets[index] + 8 # +8 to cut out type_and_id and size
             size = self._get_item_size(index)
-            return (size, f.read(size))
+            return (size, buffer(self.data, offset, size))
         return None
 
-    def find_item(self, f, item_type, index):
+    def _decode_item(self, schema, index):
+        """Returns the item decoded with the :class:`Schema
+        <tml.schemas.Schema>`."""
+        item_size, item_data = self.get_item(index)
+        return schema.decode(item_data, item_size)
+
+    def find_item(self, item_type, index):
         """Finds the item and returns it from the file.
 
-        :param f: Filepointer
         :param item_type:
         :param index:
         """
         start, num = self.get_item_type(item_type)
         if num and index < num:
-            return self.get_item(f, start+index)
+            return self.get_item(start+index)
         return None
 
     def _get_compressed_data_size(self, index):
@@ -296,11 +558,168 @@ class DataFileReader(object):
             return self.header.data_size - self.data_offsets[index]
         return self.data_offsets[index+1] - self.data_offsets[index]
 
-    def get_compressed_data(self, f, index):
-        """Returns the compressed data and size of it from the file."""
+    def get_compressed_data(self, index):
+        """Returns a buffer with the compressed data part of the file."""
         size = self._get_compressed_data_size(index)
-        f.seek(self.header.size + self.header.item_size + self.data_offsets[index])
-        return f.read(size)
+        offset = self.header.size + self.header.item_size + self.data_offsets[index]
+        return buffer(self.data, offset, size)
+
+    def get_data(self, index, decode):
+        """Returns the decoded data part.
+
+        If the reader is lazy, a :class:`LazyData <tml.items.LazyData>` is
+        returned instead, which decodes the data on first access.
+
+        :param index: Index of the data part
+        :param decode: Callable turning the decompressed data into the value
+        """
+        if index in self._decompressed:
+            return decode(self._decompressed.pop(index))
+        if self.lazy:
+            return items.LazyData(decode, self.get_compressed_data(index),
+                                  self.data_sizes[index], self.blocks)
+        return decode(self._decompress(index))
+
+    def _decompress(self, index):
+        """Decompresses the data part and remembers the compressed data."""
+        compressed = self.get_compressed_data(index)
+        data = decompress(compressed)
+        self.blocks[data_key(data)] = compressed
+        return data
+
+    def _data_indices(self):
+        """Returns the indices of all tile, quad and image data parts."""
+        indices = set()
+        start, num = self.get_item_type(ITEM_IMAGE)
+        for i in range(num):
+            item = self._decode_item(schemas.IMAGE, start+i)
+            if not item['external']:
+                indices.add(item['data'])
+        start, num = self.get_item_type(ITEM_LAYER)
+        for i in range(num):
+            item_size, item_data = self.get_item(start+i)
+            type_ = schemas.LAYER.decode(item_data, 12)['type']
+            if type_ == LAYERTYPE_TILES:
+                item = schemas.TILELAYER.decode(item_data, item_size)
+                indices.add(item['data'])
+                if item['game'] == 2:
+                    indices.update(item['extra'][:1])
+                elif item['game'] == 4:
+                    indices.update(item['extra'][1:2])
+            elif type_ == LAYERTYPE_QUADS:
+                indices.add(schemas.QUADLAYER.decode(item_data,
+                                                     item_size)['data'])
+        return [index for index in indices
+                if -1 < index < self.header.num_raw_data]
+
+    def _known_data_indices(self):
+        """Returns the indices of all data parts known items reference."""
+        indices = set(self._data_indices())
+        item = self.find_item(ITEM_INFO, 0)
+        if item is not None:
+            item_size, item_data = item
+            item = schemas.INFO.decode(item_data, item_size)
+            indices.update([item[name] for name in ('author', 'map_version',
+                            'credits', 'license', 'settings')])
+        start, num = self.get_item_type(ITEM_IMAGE)
+        for i in range(num):
+            indices.add(self._decode_item(schemas.IMAGE, start+i)['name'])
+        return indices
+
+    def _load_unknown(self):
+        """Keeps the items of unknown types and all data parts which are
+        not referenced by known items as they are."""
+        for item_type in self.item_types:
+            if 0 <= item_type['type'] < len(ITEM_TYPES):
+                continue
+            for index in range(item_type['start'],
+                               item_type['start']+item_type['num']):
+                offset = self.header.size + self.item_offsets[index]
+                type_and_id = unpack_from('i', self.data, offset)[0]
+                item_size, item_data = self.get_item(index)
+                self.unknown_items[(item_type['type'],
+                                    type_and_id & 0xffff)] = str(item_data)
+        known = self._known_data_indices()
+        for index in range(self.header.num_raw_data):
+            if index not in known:
+                self.unknown_datas[index] = items.LazyData(_decode_raw,
+                    self.get_compressed_data(index), self.data_sizes[index])
+
+    def _decompress_all(self, indices):
+        """Decompresses the data parts on a pool of worker threads.
+
+        zlib releases the GIL, so the data parts are decompressed truly in
+        parallel. The results are used by :meth:`get_data`.
+        """
+        compressed = [self.get_compressed_data(index) for index in indices]
+        pool = ThreadPool(self.workers)
+        try:
+            datas = pool.map(decompress, compressed)
+        finally:
+            pool.close()
+            pool.join()
+        for data, compressed_data in zip(datas, compressed):
+            self.blocks[data_key(data)] = compressed_data
+        self._decompressed = dict(zip(indices, datas))
+
+    def _get_extra_data(self, extra, pos, decode):
+        """Returns the data referenced at `pos` of the extra ints of an
+        item, if there is any."""
+        if len(extra) > pos: # some security
+            index = extra[pos]
+            if -1 < index < self.header.num_raw_data:
+                return self.get_data(index, decode)
+        return None
+
+def scan(map_path):
+    """Returns the metadata of a map without loading it completely.
+
+    See :meth:`DataFileReader.metadata` for the returned information.
+
+    :param map_path: Path to the mapfile, the extension is optional.
+    """
+    with DataFileReader(map_path, load_items=False) as reader:
+        return reader.metadata()
+
+def fingerprint(map_path):
+    """Returns the fingerprint of a map without loading it.
+
+    See :meth:`DataFileReader.fingerprint`.
+
+    :param map_path: Path to the mapfile, the extension is optional.
+    """
+    with DataFileReader(map_path, load_items=False) as reader:
+        return reader.fingerprint()
+
+def crc(map_path):
+    """Returns the CRC32 and the size of a mapfile.
+
+    The server identifies maps by this CRC and sends the size to clients
+    downloading the map. The file is read in chunks, nothing is loaded.
+
+    :param map_path: Path to the mapfile, the extension is optional. Can
+                     also be a readable file-like object.
+    :returns: tuple of the unsigned CRC32 and the size in bytes.
+    """
+    if hasattr(map_path, 'read'):
+        f = map_path
+    else:
+        if os.path.splitext(map_path)[1] == '':
+            map_path = os.extsep.join([map_path, 'map'])
+        f = open(map_path, 'rb')
+    try:
+        checksum = 0
+        size = 0
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            checksum = crc32(chunk, checksum)
+            size += len(chunk)
+    finally:
+        if f is not map_path:
+            f.close()
+    return checksum & 0xffffffff, size
 
 class DataFileWriter(object):
 
@@ -309,7 +728,7 @@ class DataFileWriter(object):
         def __init__(self, type_, id_, data):
             self.type = type_
             self.id = id_
-            self.data = '{0}{1}'.format(pack('2i', (self.type<<16)|self.id, len(data)), data)
+            self.data = '{0}{1}'.format(pack('2i', int32((self.type<<16)|self.id), len(data)), data)
             self.size = len(self.data)
 
         def __lt__(self, other):
@@ -323,53 +742,104 @@ class DataFileWriter(object):
             return '<DataFileItem ({0})>'.format((self.type<<16)|self.id)
 
     class DataFileData(object):
+        """A data part, compressed later on by :meth:`compress`.
+
+        :param data: The raw data or a :class:`LazyData
+                     <tml.items.LazyData>` whose compressed data is used
+                     as it is.
+        """
 
         def __init__(self, data):
-            self.uncompressed_size = len(data)
-            self.data = compress(data)
-            self.compressed_size = len(self.data)
-
-    def __init__(self, teemap, map_path):
-        path, filename = os.path.split(map_path)
-        name, extension = os.path.splitext(filename)
-        if extension == '':
-            map_path = os.extsep.join([map_path, 'map'])
-        elif extension != ''.join([os.extsep, 'map']):
-            raise ValueError('Invalid fileextension')
+            self.data = None
+            self.compressed_size = 0
+            self.lazy = None
+            if isinstance(data, items.LazyData):
+                self.lazy = data
+                self.uncompressed_size = data.size
+                self.set_compressed(data.data)
+            else:
+                self.uncompressed_size = len(data)
+                self.raw = data
+
+        def compress(self, compression='default'):
+            self.set_compressed(_compress((buffer(self.raw),
+                self.compression_settings(compression))))
+
+        def compression_settings(self, compression='default'):
+            """Returns the zlib level and memory level for the data part."""
+            small, large = COMPRESSION_PROFILES[compression]
+            if self.uncompressed_size <= COMPRESSION_SMALL_SIZE:
+                return small
+            return large
+
+        def set_compressed(self, data):
+            self.data = data
+            self.compressed_size = len(data)
+            self.raw = None
+
+    def __init__(self, teemap, map_path, workers=1, compression='default',
+                 incremental=False):
+        if compression not in COMPRESSION_PROFILES:
+            raise ValueError('Unknown compression profile "{0}"'.format(
+                             compression))
+        f = None
+        if hasattr(map_path, 'write'):
+            f, map_path = map_path, None
+        else:
+            path, filename = os.path.split(map_path)
+            name, extension = os.path.splitext(filename)
+            if extension == '':
+                map_path = os.extsep.join([map_path, 'map'])
+            elif extension != ''.join([os.extsep, 'map']):
+                raise ValueError('Invalid fileextension')
+            # a mapped file can't be replaced on every platform, so the map
+            # is detached from the file it is overwriting
+            mapping = getattr(teemap, '_mapping', None)
+            if mapping is not None and \
+               mapping.path == os.path.realpath(map_path):
+                teemap.close()
         teemap.validate()
         items_ = []
-        datas = []
+        self.datas = datas = []
+        self.compression = compression
+        self._shared_datas = {}
+        # unknown items may reference these data parts by their index
+        self._reserved_datas = dict(getattr(teemap, 'unknown_datas', {}))
         # add version item
-        items_.append(DataFileWriter.DataFileItem(ITEM_VERSION, 0, pack('i', 1)))
+        items_.append(DataFileWriter.DataFileItem(ITEM_VERSION, 0,
+                          schemas.VERSION.encode({'version': 1})))
         # save map info
         if teemap.info:
             num = 5*[-1]
             for i, type_ in enumerate(['author', 'map_version', 'credits', 'license']):
                 item_data = getattr(teemap.info, type_)
                 if item_data:
-                    num[i] = len(datas)
                     item_data += '\x00' # 0 termination
-                    datas.append(DataFileWriter.DataFileData(item_data))
+                    num[i] = self.add_data(item_data)
             if teemap.info.settings:
-                num[4] = len(datas)
                 settings_str = ''
                 for setting in teemap.info.settings:
                     settings_str += '{0}\x00'.format(setting)
-                datas.append(DataFileWriter.DataFileData(settings_str))
+                num[4] = self.add_data(settings_str)
+            author, map_version, credits, license, settings = num
             items_.append(DataFileWriter.DataFileItem(ITEM_INFO, 0,
-                              pack('6i', 1, *num)))
+                              schemas.INFO.encode({'version': 1,
+                                  'author': author, 'map_version': map_version,
+                                  'credits': credits, 'license': license,
+                                  'settings': settings})))
         # save images
         for i, image in enumerate(teemap.images):
-            image_name = len(datas)
             name_str = '{0}\x00'.format(image.name)
-            datas.append(DataFileWriter.DataFileData(name_str))
+            image_name = self.add_data(name_str)
             image_data = -1
-            if image.external is False and image.data:
-                image_data = len(datas)
-                datas.append(DataFileWriter.DataFileData(image.data))
+            data = _raw_data(image, 'data', _decode_raw)
+            if image.external is False and data:
+                image_data = self.add_data(data)
             items_.append(DataFileWriter.DataFileItem(ITEM_IMAGE, i,
-                              pack('6i', 1, image.width, image.height,
-                              image.external, image_name, image_data)))
+                              schemas.IMAGE.encode({'version': 1,
+                                  'width': image.width, 'height': image.height,
+                                  'external': image.external,
+                                  'name': image_name, 'data': image_data})))
         # save layers and groups
         layer_count = 0
         for i, group in enumerate(teemap.groups):
@@ -379,66 +849,67 @@ class DataFileWriter(object):
                     tile_data = -1
                     tele_tile_data = -1
                     speedup_tile_data = -1
-                    tiles_str = ''
                     if layer.is_telelayer:
-                        tile_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(len(layer.tele_tiles.tiles)*'\x00\x00\x00\x00'))
-                        for tile in layer.tele_tiles.tiles:
-                            tiles_str += tile
-                        tele_tile_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(tiles_str))
+                        tile_data = self.add_data(layer._num_tiles()*'\x00\x00\x00\x00')
+                        tele_tile_data = self.add_data(
+                            _raw_data(layer, 'tele_tiles', _encode_tiles))
                     elif layer.is_speeduplayer:
-                        tile_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(len(layer.speedup_tiles.tiles)*'\x00\x00\x00\x00'))
-                        for tile in layer.speedup_tiles.tiles:
-                            tiles_str += tile
-                        speedup_tile_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(tiles_str))
-                    else:
-                        for tile in layer.tiles.tiles:
-                            tiles_str += tile
-                        tile_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(tiles_str))
-                    name = string_to_ints(layer.name, 3)
-                    if teemap.telelayer or teemap.speeduplayer:
-                        items_.append(DataFileWriter.DataFileItem(ITEM_LAYER, layer_count,
-                               pack('20i', 0, LAYERTYPE_TILES, layer.detail, 3, layer.width,
-                               layer.height, layer.game, layer.color[0], layer.color[1],
-                               layer.color[2], layer.color[3], layer.color_env,
-                               layer.color_env_offset, layer.image_id, tile_data, name[0],
-                               name[1], name[2], tele_tile_data, speedup_tile_data)))
+                        tile_data = self.add_data(layer._num_tiles()*'\x00\x00\x00\x00')
+                        speedup_tile_data = self.add_data(
+                            _raw_data(layer, 'speedup_tiles', _encode_tiles))
                     else:
-                        items_.append(DataFileWriter.DataFileItem(ITEM_LAYER, layer_count,
-                               pack('18i', 0, LAYERTYPE_TILES, layer.detail, 3, layer.width,
-                               layer.height, layer.game, layer.color[0], layer.color[1],
-                               layer.color[2], layer.color[3], layer.color_env,
-                               layer.color_env_offset, layer.image_id, tile_data, *name)))
+                        # the client changes the tiles of the gamelayer in
+                        # place, so they must not be shared with other layers
+                        tile_data = self.add_data(
+                            _raw_data(layer, 'tiles', _encode_tiles),
+                            share=not layer.is_gamelayer)
+                    extra = ()
+                    if teemap.telelayer or teemap.speeduplayer or layer.extra:
+                        extra = (tele_tile_data, speedup_tile_data) + \
+                                tuple(layer.extra)
+                    items_.append(DataFileWriter.DataFileItem(ITEM_LAYER, layer_count,
+                           schemas.TILELAYER.encode({'layer_version': 0,
+                               'type': LAYERTYPE_TILES, 'flags': layer.detail,
+                               'version': 3, 'width': layer.width,
+                               'height': layer.height, 'game': layer.game,
+                               'color': layer.color, 'color_env': layer.color_env,
+                               'color_env_offset': layer.color_env_offset,
+                               'image_id': layer.image_id, 'data': tile_data,
+                               'name': layer.name}, extra)))
                     layer_count += 1
                 elif layer.type == 'quadlayer':
-                    if len(layer.quads.quads):
-                        quads_str = ''
-                        for quad in layer.quads.quads:
-                            quads_str += quad
-                        quad_data = len(datas)
-                        datas.append(DataFileWriter.DataFileData(quads_str))
-                        name = string_to_ints(layer.name, 3)
+                    num_quads = layer._num_quads()
+                    if num_quads:
+                        quad_data = self.add_data(
+                            _raw_data(layer, 'quads', _encode_quads))
                         items_.append(DataFileWriter.DataFileItem(ITEM_LAYER, layer_count,
-                               pack('10i', 7, LAYERTYPE_QUADS, layer.detail, 2,
-                               len(layer.quads.quads), quad_data, layer.image_id, *name)))
+                               schemas.QUADLAYER.encode({'layer_version': 7,
+                                   'type': LAYERTYPE_QUADS, 'flags': layer.detail,
+                                   'version': 2, 'num_quads': num_quads,
+                                   'data': quad_data, 'image_id': layer.image_id,
+                                   'name': layer.name}, layer.extra)))
                         layer_count += 1
-            name = string_to_ints(group.name, 3)
+            # empty quadlayers are left out
             items_.append(DataFileWriter.DataFileItem(ITEM_GROUP, i,
-                   pack('15i', 3, group.offset_x, group.offset_y, group.parallax_x,
-                   group.parallax_y, start_layer, len(group.layers),
-                   group.use_clipping, group.clip_x, group.clip_y, group.clip_w,
-                   group.clip_h, *name)))
+                   schemas.GROUP.encode({'version': 3,
+                       'offset_x': group.offset_x, 'offset_y': group.offset_y,
+                       'parallax_x': group.parallax_x,
+                       'parallax_y': group.parallax_y,
+                       'start_layer': start_layer,
+                       'num_layers': layer_count - start_layer,
+                       'use_clipping': group.use_clipping,
+                       'clip_x': group.clip_x, 'clip_y': group.clip_y,
+                       'clip_w': group.clip_w, 'clip_h': group.clip_h,
+                       'name': group.name})))
         # save envelopes
         start_point = 0
         for i, envelope in enumerate(teemap.envelopes):
             num_points = len(envelope.envpoints)
-            name = string_to_ints(envelope.name)
             items_.append(DataFileWriter.DataFileItem(ITEM_ENVELOPE, i,
-                   pack('12i', 1, envelope.channels, start_point, num_points, *name)))
+                   schemas.ENVELOPE.encode({'version': 1,
+                       'channels': envelope.channels,
+                       'start_point': start_point, 'num_points': num_points,
+                       'name': envelope.name})))
             start_point += num_points
         # save points
         envpoints = []
@@ -446,64 +917,300 @@ class DataFileWriter(object):
             values = 4*[0]
             for i, value in enumerate(envpoint.values):
                 values[i] = value
-            envpoints.extend([envpoint.time, envpoint.curvetype, values[0],
-                              values[1], values[2], values[3]])
-        fmt = '{0}i'.format(len(envpoints))
+            envpoints.append({'time': envpoint.time,
+                              'curvetype': envpoint.curvetype,
+                              'values': values})
         items_.append(DataFileWriter.DataFileItem(ITEM_ENVPOINT, 0,
-               pack(fmt, *envpoints)))
+               schemas.ENVPOINT.encode_all(envpoints)))
+        # pass through unknown items and their data parts
+        for (type_, id_), data in getattr(teemap, 'unknown_items', {}).items():
+            items_.append(DataFileWriter.DataFileItem(type_, id_, data))
+        self._add_reserved_datas(remaining=True)
         items_.sort()
+        self.items = items_
+        self.workers = workers
+        self.blocks = getattr(teemap, '_blocks', None)
+        if compression == 'max':
+            # compress everything again instead of reusing loaded data parts
+            self.blocks = None
+        self.patched = False
+
+        if f is not None:
+            self.write(f)
+            return
+        if incremental and os.path.exists(map_path):
+            self.patched = self.patch(map_path)
+            if self.patched:
+                return
+        # the map is written to a temporary file first, because unchanged
+        # data parts may still be read from the old file. It replaces the
+        # target of a symlink instead of the link.
+        map_path = os.path.realpath(map_path)
+        if os.path.exists(map_path):
+            mode = stat.S_IMODE(os.stat(map_path).st_mode)
+        else:
+            mode = _NEW_FILE_MODE
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                            dir=os.path.dirname(os.path.abspath(map_path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.write(f)
+            os.chmod(tmp_path, mode)
+            _replace_file(tmp_path, map_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def add_data(self, data, share=True):
+        """Adds a data part and returns its index.
+
+        Identical data parts are only added once and share their index.
 
-        # calculate header
-        item_size = 0
-        num_item_types = 1
+        :param data: The raw data or a :class:`LazyData
+                     <tml.items.LazyData>` which is passed through.
+        :param share: ``False`` if the data part must not be shared.
+        """
+        if isinstance(data, items.LazyData) and self.compression == 'max':
+            data = decompress(data.data)
+        if isinstance(data, items.LazyData):
+            # identical compressed data means identical content
+            key = ('compressed', data_key(data.data))
+        else:
+            key = data_key(data)
+        if share:
+            for index in self._shared_datas.get(key, []):
+                other = self.datas[index]
+                other = other.lazy.data if other.lazy else other.raw
+                if isinstance(data, items.LazyData):
+                    if buffer(other) == buffer(data.data):
+                        return index
+                elif buffer(other) == buffer(data):
+                    return index
+        self._add_reserved_datas()
+        self._append_data(data)
+        index = len(self.datas) - 1
+        if share:
+            self._shared_datas.setdefault(key, []).append(index)
+        return index
+
+    def _append_data(self, data):
+        if isinstance(data, items.LazyData) and self.compression == 'max':
+            data = decompress(data.data)
+        self.datas.append(DataFileWriter.DataFileData(data))
+
+    def _add_reserved_datas(self, remaining=False):
+        """Adds the data parts which must keep their index.
+
+        :param remaining: If ``True``, the remaining reserved data parts are added
+                    as well, gaps before them are filled with empty data
+                    parts.
+        """
+        while len(self.datas) in self._reserved_datas:
+            self._append_data(self._reserved_datas.pop(len(self.datas)))
+        if remaining:
+            for index in sorted(self._reserved_datas):
+                while len(self.datas) < index:
+                    self._append_data('')
+                self._append_data(self._reserved_datas.pop(index))
+
+    def write(self, f):
+        """Writes the map to the file-like object `f`.
+
+        The data parts are compressed and written one after another, so
+        only a few of them are held in memory at once. The header, which
+        depends on the compressed sizes, is written at the end if `f` is
+        seekable. Otherwise the data parts are spooled to a temporary file
+        first.
+        """
+        try:
+            start = f.tell()
+            f.seek(start)
+        except (AttributeError, IOError, ValueError):
+            start = None
+
+        if start is not None:
+            f.write('\x00' * self._header_size())
+            for item in self.items:
+                f.write(item.data)
+            self._write_datas(f)
+            end = f.tell()
+            f.seek(start)
+            self._write_header(f)
+            f.seek(end)
+        else:
+            spool = tempfile.TemporaryFile()
+            try:
+                self._write_datas(spool)
+                spool.seek(0)
+                self._write_header(f)
+                for item in self.items:
+                    f.write(item.data)
+                shutil.copyfileobj(spool, f)
+            finally:
+                spool.close()
+
+    def patch(self, map_path):
+        """Writes only the changed parts of the existing map at `map_path`.
+
+        The header and the items are rewritten and every data part which
+        is not in the file at the same position already is written. Returns
+        ``False`` without changing the file if it can not be patched, e.g.
+        because the size of the items changed, which moves all data parts,
+        or more than half of the file would be written anyway.
+
+        The file is changed in place, so the map is not valid while it is
+        written. Other readers and maps which have the file open would read
+        the new data at old positions, so the file is not patched as long as
+        any of them has it mapped. Programs reading it without tml don't
+        notice the patch.
+        """
+        mappings = _mappings.get(os.path.realpath(map_path))
+        if mappings:
+            return False
+        with open(map_path, 'r+b') as f:
+            try:
+                header = Header(f.read(36))
+            except TypeError:
+                return False
+            num_datas = header.num_raw_data
+            f.seek(36 + header.num_item_types*12 + header.num_items*4)
+            old_offsets = unpack('{0}i'.format(num_datas), f.read(num_datas*4))
+            old_offsets += (header.data_size,)
+            start = header.size + header.item_size
+            f.seek(0, os.SEEK_END)
+            if f.tell() != start + header.data_size:
+                return False
+
+            meta = BytesIO()
+            datas = list(self.compress(self.datas, self.workers, self.blocks,
+                                       self.compression))
+            self._write_header(meta)
+            for item in self.items:
+                meta.write(item.data)
+            meta = meta.getvalue()
+            if len(meta) != start:
+                return False
+
+            changed = []
+            offset = 0
+            for i, data in enumerate(datas):
+                size = data.compressed_size
+                if i >= num_datas or old_offsets[i] != offset or \
+                   old_offsets[i+1] - old_offsets[i] != size:
+                    changed.append((offset, data))
+                else:
+                    f.seek(start + offset)
+                    if buffer(f.read(size)) != buffer(data.data):
+                        changed.append((offset, data))
+                offset += size
+            if sum([data.compressed_size for _, data in changed]) * 2 > \
+               start + offset:
+                return False
+
+            changed = [(position, str(data.data)) for position, data in changed]
+            for position, data in changed:
+                f.seek(start + position)
+                f.write(data)
+            f.seek(0)
+            f.write(meta)
+            f.truncate(start + offset)
+        return True
+
+    def _write_datas(self, f):
+        for data in self.compress(self.datas, self.workers, self.blocks,
+                                  self.compression):
+            f.write(data.data)
+            # keep only the size, the compressed data is not needed anymore
+            data.data = None
+
+    def _item_types(self):
+        """Returns the item types as flat list of type, start and number."""
         item_types = []
-        for i in range(len(items_)):
-            item_size += items_[i].size
-            if i > 0 and items_[i].type != items_[i-1].type:
-                num_item_types += 1
-        for i in range(7):
-            num = 0
-            start = -1
-            for j, item in enumerate(items_):
-                if item.type == i:
-                    num += 1
-                    if start < 0:
-                        start = j
-            if start > -1:
-                item_types.extend([i, start, num])
-        data_size = 0
-        for data in datas:
-            data_size += data.compressed_size
-        item_types_size = num_item_types*12
-        header_size = 36
-        offset_size = (len(items_) + 2*len(datas)) * 4
-        file_size = header_size + item_types_size + offset_size + item_size + data_size - 16
+        for i, item in enumerate(self.items):
+            if i == 0 or item.type != self.items[i-1].type:
+                item_types.extend([item.type, i, 0])
+            item_types[-1] += 1
+        return item_types
+
+    def _header_size(self):
+        """Returns the size of the header including all offset tables."""
+        num_item_types = len(self._item_types()) // 3
+        return 36 + num_item_types*12 + (len(self.items) + 2*len(self.datas))*4
+
+    def _write_header(self, f):
+        """Writes the header, the compressed sizes must be known already."""
+        item_types = self._item_types()
+        num_item_types = len(item_types) // 3
+        item_size = sum([item.size for item in self.items])
+        data_size = sum([data.compressed_size for data in self.datas])
+        file_size = self._header_size() + item_size + data_size - 16
         swaplen = file_size - data_size
 
-        # write file
-        with open(map_path, 'wb') as f:
-            f.write('DATA') # file signature
-            header_str = pack('8i', 4, file_size, swaplen, num_item_types,
-                          len(items_), len(datas), item_size, data_size)
-            f.write(header_str)
-            fmt = '{0}i'.format(len(item_types))
-            item_types_str = pack(fmt, *item_types)
-            f.write(item_types_str)
-            item_offset_str = ''
-            offset = 0
-            for item in items_:
-                item_offset_str += pack('i', offset)
-                offset += item.size
-            f.write(item_offset_str)
-            data_offset_str = ''
-            offset = 0
-            for data in datas:
-                data_offset_str += pack('i', offset)
-                offset += data.compressed_size
-            f.write(data_offset_str)
-            for data in datas:
-                f.write(pack('i', data.uncompressed_size))
-            for item in items_:
-                f.write(item.data)
-            for data in datas:
-                f.write(data.data)
+        f.write('DATA') # file signature
+        f.write(pack('8i', 4, file_size, swaplen, num_item_types,
+                     len(self.items), len(self.datas), item_size, data_size))
+        fmt = '{0}i'.format(len(item_types))
+        f.write(pack(fmt, *item_types))
+        offsets = []
+        offset = 0
+        for item in self.items:
+            offsets.append(offset)
+            offset += item.size
+        fmt = '{0}i'.format(len(offsets))
+        f.write(pack(fmt, *offsets))
+        offsets = []
+        offset = 0
+        for data in self.datas:
+            offsets.append(offset)
+            offset += data.compressed_size
+        fmt = '{0}i'.format(len(offsets))
+        f.write(pack(fmt, *offsets))
+        fmt = '{0}i'.format(len(self.datas))
+        f.write(pack(fmt, *[data.uncompressed_size for data in self.datas]))
+
+    @staticmethod
+    def compress(datas, workers=1, blocks=None, compression='default'):
+        """Compresses the data parts and yields them in their order.
+
+        Up to `workers` data parts are compressed at once on a pool of
+        threads. Every data part is compressed on its own, so the result is
+        the same as compressing them one after another.
+
+        :param blocks: Compressed data parts of the loaded map by the
+                       :func:`data_key <tml.utils.data_key>` of their
+                       content. Unchanged data parts are taken from there
+                       instead of compressing them again.
+        :param compression: Name of the compression profile, see
+                            :data:`COMPRESSION_PROFILES
+                            <tml.constants.COMPRESSION_PROFILES>`.
+        """
+        workers = max(1, workers)
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            for i in range(0, len(datas), workers):
+                batch = datas[i:i+workers]
+                todo = []
+                for data in batch:
+                    if data.data is not None:
+                        continue
+                    if blocks:
+                        compressed = blocks.get(data_key(data.raw))
+                        if compressed is not None:
+                            data.set_compressed(compressed)
+                            continue
+                    todo.append(data)
+                if pool is not None and len(todo) > 1:
+                    compressed = pool.map(_compress, [(buffer(data.raw),
+                        data.compression_settings(compression))
+                        for data in todo])
+                    for data, compressed_data in zip(todo, compressed):
+                        data.set_compressed(compressed_data)
+                else:
+                    for data in todo:
+                        data.compress(compression)
+                for data in batch:
+                    yield data
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
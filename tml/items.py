@@ -9,21 +9,195 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 
+from array import array
+from bisect import bisect_left
+from collections import MutableSequence
+from hashlib import sha1
+from itertools import izip
 import os
+import re
 import shutil
-from struct import unpack, pack
+from struct import Struct, unpack, pack
+import sys
 import warnings
+import weakref
 from zlib import decompress
 
 import png
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from constants import ITEM_TYPES, TML_DIR, TILEFLAG_VFLIP, \
-     TILEFLAG_HFLIP, TILEFLAG_OPAQUE, TILEFLAG_ROTATE
-from utils import ints_to_string
+     TILEFLAG_HFLIP, TILEFLAG_OPAQUE, TILEFLAG_ROTATE, TILEINDEX
+from utils import data_key, ints_to_string
 
 #GAMELAYER_IMAGE = PIL.Image.open(os.path.join(TML_DIR,
 #	os.extsep.join(('entities', 'png'))))
 
+class LazyData(object):
+    """Compressed raw data which is only decoded on first access.
+
+    Used internally when a map is loaded with ``lazy=True``, you probably
+    don't need it.
+
+    :param decode: Callable turning the decompressed data into the value.
+    :param data: The compressed data block.
+    :param size: Size of the decompressed data.
+    :param blocks: Dict the compressed data is registered in by
+                   :func:`data_key <tml.utils.data_key>` once it is
+                   decompressed.
+    """
+
+    def __init__(self, decode, data, size=None, blocks=None):
+        self.decode = decode
+        self.data = data
+        self.size = size
+        self.blocks = blocks
+
+    def raw(self):
+        """Returns the decompressed data without decoding it."""
+        return decompress(self.data)
+
+    def load(self):
+        data = decompress(self.data)
+        if self.blocks is not None:
+            self.blocks[data_key(data)] = self.data
+        return self.decode(data)
+
+    def __repr__(self):
+        return '<LazyData ({0})>'.format(len(self.data))
+
+def peek(obj, name):
+    """Returns the value of a :class:`lazy_attribute` without loading it."""
+    return obj.__dict__.get(''.join(['_', name]))
+
+def peek_raw(obj, name, encode):
+    """Returns the raw data of a :class:`lazy_attribute` without decoding it.
+
+    :param encode: Callable turning a loaded value into its raw data.
+    :returns: The raw data or ``None`` if the attribute is not set.
+    """
+    value = peek(obj, name)
+    if isinstance(value, LazyData):
+        return value.raw()
+    if value is None:
+        return None
+    return encode(value)
+
+def fingerprint(values, datas=()):
+    """Returns a hash of some values and raw data parts.
+
+    Used for the fingerprints of layers and maps, the hash only depends on
+    the content and not on how it was compressed.
+    """
+    hash_ = sha1(repr(values))
+    for data in datas:
+        if data is None:
+            hash_.update(pack('i', -1))
+        else:
+            hash_.update(pack('i', len(data)))
+            hash_.update(buffer(data))
+    return hash_.hexdigest()
+
+class lazy_attribute(object):
+    """Attribute which may hold :class:`LazyData` until it is accessed."""
+
+    def __init__(self, name):
+        self.name = ''.join(['_', name])
+
+    def __get__(self, obj, type_=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.name)
+        if isinstance(value, LazyData):
+            value = value.load()
+            obj.__dict__[self.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+class ItemList(MutableSequence):
+    """The groups of a map or the layers of a group.
+
+    Works on the list it was created with instead of a copy and tells its
+    owner about every change, so a map can keep the index of its layers
+    until one of them changes. Changes made to the wrapped list itself are
+    not noticed, make them through the attribute of the map or group.
+    """
+
+    def __init__(self, items, owner):
+        self._items = items
+        # no reference cycle, so maps are freed as soon as they are unused
+        self._owner = weakref.ref(owner)
+
+    def _changed(self):
+        owner = self._owner()
+        if owner is not None:
+            owner._changed()
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+        self._changed()
+
+    def __delitem__(self, index):
+        del self._items[index]
+        self._changed()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        self._items.sort(*args, **kwargs)
+        self._changed()
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, ItemList):
+            other = other._items
+        return self._items == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._items)
+
+def _item_list(items, owner):
+    """Returns `items` as :class:`ItemList` of `owner`."""
+    if isinstance(items, ItemList) and items._owner() is owner:
+        return items
+    return ItemList(items, owner)
+
+def _add_map(obj, teemap):
+    """Remembers that `teemap` indexed the group or layer `obj`."""
+    maps = obj.__dict__.get('_maps')
+    if maps is None:
+        maps = obj.__dict__['_maps'] = weakref.WeakSet()
+    maps.add(teemap)
+
+def _changed(obj):
+    """Tells the maps which indexed the group or layer `obj` it changed."""
+    for teemap in obj.__dict__.get('_maps', ()):
+        teemap._changed()
+
 class Info(object):
     """Represents a map info object.
 
@@ -55,6 +229,8 @@ class Image(object):
     # size in ints
     type_size = 6
 
+    data = lazy_attribute('data')
+
     def __init__(self, name, width=0, height=0, external=False, data=None,
                  path=''):
         self.name = name
@@ -162,7 +338,19 @@ class Group(object):
         self.clip_y = clip_y
         self.clip_w = clip_w
         self.clip_h = clip_h
-        self.layers = layers or []
+        self.layers = [] if layers is None else layers
+
+    @property
+    def layers(self):
+        return self._layers
+
+    @layers.setter
+    def layers(self, layers):
+        self._layers = _item_list(layers, self)
+        self._changed()
+
+    def _changed(self):
+        _changed(self)
 
     def append(self, layer):
         """Adds a layer to the group.
@@ -193,6 +381,9 @@ class Layer(object):
 
     def __init__(self, detail):
         self.detail = detail
+        # ints the layer item has after the known fields, written back as
+        # they are
+        self.extra = ()
 
     @property
     def is_gamelayer(self):
@@ -223,6 +414,12 @@ class TileLayer(Layer):
 
     type_size = 18
 
+    tiles = lazy_attribute('tiles')
+    tele_tiles = lazy_attribute('tele_tiles')
+    speedup_tiles = lazy_attribute('speedup_tiles')
+    # names of all tile managers a layer can have
+    _managers = ('tiles', 'tele_tiles', 'speedup_tiles')
+
     def __init__(self, width=50, height=50, name='Tiles', detail=False, game=0,
                  color=(255, 255, 255, 255), color_env=-1, color_env_offset=0,
                  image_id=-1, tiles=None, tele_tiles=None, speedup_tiles=None):
@@ -239,9 +436,9 @@ class TileLayer(Layer):
         self.tele_tiles = None
         self.speedup_tiles = None
         if game == 2:
-            self.tele_tiles = tele_tiles or TileManager(width * height, _type=1)
+            self.tele_tiles = tele_tiles or TeleTileManager(width * height)
         if game == 4:
-            self.speedup_tiles = speedup_tiles or TileManager(width * height, _type=2)
+            self.speedup_tiles = speedup_tiles or SpeedupTileManager(width * height)
         self.type = 'tilelayer'
 
     def _check_bounds(self, x, y):
@@ -250,6 +447,25 @@ class TileLayer(Layer):
         if not 0 <= y < self.height:
             raise ValueError('y is out of bounds')
 
+    def _num_tiles(self):
+        """Returns the number of tiles without loading lazy tiles."""
+        tiles = peek(self, 'tiles')
+        if isinstance(tiles, LazyData) and tiles.size is not None:
+            return tiles.size // TileManager.tile_sizes[0]
+        return len(self.tiles)
+
+    def fingerprint(self):
+        """Returns a hash of the content of the layer.
+
+        Lazy tiles are decompressed for it, but not decoded.
+        """
+        values = ('tiles', self.name or '', bool(self.detail), self.width,
+                  self.height, self.game, tuple(self.color), self.color_env,
+                  self.color_env_offset, self.image_id, tuple(self.extra))
+        encode = lambda tiles: tiles.data
+        return fingerprint(values, [peek_raw(self, name, encode)
+                                    for name in self._managers])
+
     def _get_tile(self, tiles, x, y):
         self._check_bounds(x, y)
         x = max(0, min(x, self.width-1))
@@ -269,7 +485,223 @@ class TileLayer(Layer):
     def set_tile(self, x, y, tile):
         """Set a tile by coordinates."""
         self._check_bounds(x, y)
-        self.tiles[y*self.width+x] = tile
+        i = y*self.width+x
+        index = self._current_index()
+        if index is not None:
+            self._unindex(index, i, 1, 1)
+        self.tiles[i] = tile
+        if index is not None:
+            self._reindex(index, i, 1, 1)
+
+    def _cached(self, name):
+        """Returns the value cached as `name` if the tiles did not change
+        since, otherwise ``None``."""
+        cache = self.__dict__.get(name)
+        tiles = peek(self, 'tiles')
+        if cache is None or cache[0] is not tiles or \
+           cache[1] != tiles._revision or tiles._exported:
+            return None
+        return cache[2]
+
+    def _current_index(self):
+        """Returns the tile index if it is up to date, otherwise ``None``."""
+        return self._cached('_tile_index_cache')
+
+    def _tile_index(self):
+        """Returns the sorted positions of the entities, death and nohook
+        tiles by their index, built in one pass over the tiles if needed."""
+        index = self._current_index()
+        if index is None:
+            index = {}
+            if numpy is not None:
+                indices = numpy.frombuffer(self.tiles.data, dtype='u1')[0::4]
+                for value in _INDEXED_VALUES:
+                    positions = numpy.flatnonzero(indices == value)
+                    if len(positions):
+                        index[value] = array('i', positions.astype('i')
+                                                           .tostring())
+            else:
+                indices = self.tiles.data[0::4]
+                for match in _INDEXED.finditer(indices):
+                    i = match.start()
+                    index.setdefault(indices[i], array('i')).append(i)
+            self._tile_index_cache = (self.tiles, self.tiles._revision, index)
+        return index
+
+    def _unindex(self, index, start, w, h):
+        """Removes an area starting at position `start` from the index.
+
+        Every row of the area is a slice of the sorted positions, so rows
+        are scanned for indexed tiles and their slices are cut out.
+        """
+        data = self.tiles.data
+        for row in xrange(start, start + h*self.width, self.width):
+            indices = data[row*4:(row+w)*4:4]
+            for value in set([indices[match.start()] for match
+                              in _INDEXED.finditer(indices)]):
+                positions = index[value]
+                del positions[bisect_left(positions, row):
+                              bisect_left(positions, row+w)]
+
+    def _reindex(self, index, start, w, h):
+        """Adds an area starting at position `start` to the index again."""
+        data = self.tiles.data
+        for row in xrange(start, start + h*self.width, self.width):
+            indices = data[row*4:(row+w)*4:4]
+            found = {}
+            for match in _INDEXED.finditer(indices):
+                i = match.start()
+                found.setdefault(indices[i], array('i')).append(row + i)
+            for value, new in found.iteritems():
+                positions = index.setdefault(value, array('i'))
+                i = bisect_left(positions, row)
+                positions[i:i] = new
+        self._tile_index_cache = (self.tiles, self.tiles._revision, index)
+
+    def find(self, index):
+        """Returns the coordinates of all tiles with the given index.
+
+        The positions of entities, death and nohook tiles are indexed on
+        the first call, later calls are answered from the index, which is
+        kept up to date by :meth:`set_tile` and :meth:`draw`. Other changes
+        of the tiles make the next call index them again. Other tiles, e.g.
+        air and solid ones, are searched on every call.
+
+        :param index: Tile index or its name in
+                      :data:`TILEINDEX <tml.constants.TILEINDEX>`
+        :returns: List of ``(x, y)`` sorted row by row
+
+        """
+        if isinstance(index, basestring):
+            index = TILEINDEX[index]
+        if _INDEXED.match(chr(index)):
+            positions = self._tile_index().get(index, ())
+        else:
+            positions = [m.start() for m in re.finditer(re.escape(chr(index)),
+                                                self.tiles.data[0::4])]
+        width = self.width
+        return [(i % width, i // width) for i in positions]
+
+    def stats(self):
+        """Returns statistics of the tiles.
+
+        They are computed in one pass over the raw tile data, with numpy if
+        it is installed, and cached until the tiles change. Don't modify
+        the result.
+
+        :returns: dict with
+
+                  - ``histogram``: dict mapping the tile indices to the
+                    number of tiles with them
+                  - ``flags``: dict mapping the flags of tiles which are
+                    not air to the number of tiles with them
+                  - ``bbox``: ``(x, y, width, height)`` of the area with
+                    tiles which are not air, ``None`` if there are none
+                  - ``fill``: ratio of tiles which are not air
+                  - ``rows``, ``columns``: lists with the number of tiles
+                    which are not air per row and column
+
+        """
+        stats = self._cached('_stats_cache')
+        if stats is None:
+            if numpy is not None:
+                stats = self._numpy_stats()
+            else:
+                stats = self._python_stats()
+            total = self.width * self.height
+            filled = total - stats['histogram'].get(0, 0)
+            stats['fill'] = float(filled) / total if total else 0.0
+            stats['bbox'] = None
+            if filled:
+                rows = [y for y, count in enumerate(stats['rows']) if count]
+                columns = [x for x, count in enumerate(stats['columns'])
+                           if count]
+                stats['bbox'] = (columns[0], rows[0],
+                                 columns[-1] - columns[0] + 1,
+                                 rows[-1] - rows[0] + 1)
+            self._stats_cache = (self.tiles, self.tiles._revision, stats)
+        return stats
+
+    def _numpy_stats(self):
+        tiles = numpy.frombuffer(self.tiles.data, dtype='u1')
+        tiles = tiles.reshape(self.height, self.width, 4)
+        indices = tiles[..., 0]
+        nonempty = indices != 0
+        histogram = numpy.bincount(indices.ravel(), minlength=256)
+        flags = numpy.bincount(tiles[..., 1][nonempty], minlength=256)
+        return {
+            'histogram': dict((i, int(count)) for i, count
+                              in enumerate(histogram) if count),
+            'flags': dict((i, int(count)) for i, count
+                          in enumerate(flags) if count),
+            'rows': [int(count) for count in nonempty.sum(1)],
+            'columns': [int(count) for count in nonempty.sum(0)],
+        }
+
+    def _python_stats(self):
+        width = self.width
+        data = self.tiles.data
+        indices = str(data[0::4])
+        flags = str(data[1::4])
+        flag_counts = {}
+        for match in _NONEMPTY.finditer(indices):
+            value = ord(flags[match.start()])
+            flag_counts[value] = flag_counts.get(value, 0) + 1
+        return {
+            'histogram': dict((ord(c), indices.count(c))
+                              for c in set(indices)),
+            'flags': flag_counts,
+            'rows': [width - indices.count('\x00', start, start+width)
+                     for start in xrange(0, len(indices), width or 1)],
+            'columns': [self.height - indices[x::width].count('\x00')
+                        for x in xrange(width)],
+        }
+
+    def iter_tiles(self, frozen=False):
+        """Iterates over all tiles row by row.
+
+        :param frozen: If ``True``, shared :class:`FrozenTile` objects are
+                       yielded instead of new tiles.
+        :returns: Iterator of ``(x, y, tile)``
+
+        """
+        width = self.width
+        data = self.tiles.data
+        get = FrozenTile.get if frozen else lambda raw: Tile(*raw)
+        for i in xrange(len(data) // 4):
+            y, x = divmod(i, width)
+            yield x, y, get(data[i*4:i*4+4])
+
+    def iter_rows(self):
+        """Iterates over the rows of the tilelayer.
+
+        Every row is a copy of its raw tile data as bytearray with 4 bytes
+        per tile, e.g. ``row[0::4]`` are the indices of all its tiles.
+
+        """
+        size = self.width * 4
+        data = self.tiles.data
+        for start in xrange(0, len(data), size):
+            yield data[start:start+size]
+
+    def iter_nonempty(self, frozen=False):
+        """Iterates over all tiles which are not air.
+
+        The raw tile data is scanned for them, so air tiles cost nearly
+        nothing.
+
+        :param frozen: If ``True``, shared :class:`FrozenTile` objects are
+                       yielded instead of new tiles.
+        :returns: Iterator of ``(x, y, tile)``
+
+        """
+        width = self.width
+        data = self.tiles.data
+        get = FrozenTile.get if frozen else lambda raw: Tile(*raw)
+        for match in _NONEMPTY.finditer(str(data[0::4])):
+            i = match.start()
+            y, x = divmod(i, width)
+            yield x, y, get(data[i*4:i*4+4])
 
     def select(self, x, y, w=1, h=1):
         """Select an area of the tilelayer.
@@ -286,45 +718,105 @@ class TileLayer(Layer):
         y = max(0, min(y, self.height-1))
         w = max(1, min(w, self.width-x))
         h = max(1, min(h, self.height-y))
-        layer = TileLayer(w, h, game=self.game, color=self.color,
-                          color_env=self.color_env,
-                          color_env_offset=self.color_env_offset,
-                          image_id=self.image_id)
-        data = []
-        for _y in range(h):
-            for _x in range(w):
-                data.append(self.tiles.tiles[(y+_y)*self.width+(x+_x)])
-        layer.tiles = TileManager(data=data)
-        if self.tele_tiles and len(self.tele_tiles.tiles) == len(self.tiles.tiles):
-            for _y in range(h):
-                for _x in range(w):
-                    data.append(self.tele_tiles.tiles[(y+_y)*self.width+(x+_x)])
-        layer.tele_tiles = TileManager(data=data)
-        if self.speedup_tiles and len(self.speedup_tiles.tiles) == len(self.tiles.tiles):
-            for _y in range(h):
-                for _x in range(w):
-                    data.append(self.speedup_tiles.tiles[(y+_y)*self.width+(x+_x)])
-        layer.speedup_tiles = TileManager(data=data)
-        return layer
+        managers = {}
+        for attr in self._managers:
+            tiles = getattr(self, attr)
+            if tiles is not None and len(tiles) == len(self.tiles):
+                managers[attr] = tiles.get_region(self.width, x, y, w, h)
+        return TileLayer(w, h, game=self.game, color=self.color,
+                         color_env=self.color_env,
+                         color_env_offset=self.color_env_offset,
+                         image_id=self.image_id, **managers)
+
+    def view(self, x, y, w=1, h=1):
+        """Returns a view of an area of the tilelayer.
+
+        Unlike :meth:`select`, no tiles are copied, reading and writing
+        tiles of the view goes directly to this layer. The area is cut to
+        fit to the layer like in :meth:`select`.
+
+        :returns: :class:`TileLayerView`
+
+        """
+        x = max(0, min(x, self.width-1))
+        y = max(0, min(y, self.height-1))
+        w = max(1, min(w, self.width-x))
+        h = max(1, min(h, self.height-y))
+        return TileLayerView(self, x, y, w, h)
 
     def draw(self, x, y, tilelayer):
         """Draws the the passed tilelayer onto itself.
 
-        If the given tilelayer is too big, it will be cut and the rest
-        discarded.
+        If the given tilelayer is too big or placed at a negative offset, it
+        will be cut and the rest discarded. Tele and speedup tiles are
+        copied if both layers have them.
+
+        :param tilelayer: :class:`TileLayer` or :class:`TileLayerView`
 
         """
 
-        x = max(0, min(x, self.width-1))
-        y = max(0, min(y, self.height-1))
+        if isinstance(tilelayer, TileLayerView):
+            layer, offset_x, offset_y = tilelayer.layer, tilelayer.x, tilelayer.y
+        else:
+            layer, offset_x, offset_y = tilelayer, 0, 0
+        src_x = max(0, -x)
+        src_y = max(0, -y)
+        x = max(0, x)
+        y = max(0, y)
+        w = min(tilelayer.width - src_x, self.width - x)
+        h = min(tilelayer.height - src_y, self.height - y)
+        if w <= 0 or h <= 0:
+            return
+        index = self._current_index()
+        if index is not None and w*h > _INDEX_AREA:
+            # indexing all tiles again on the next find() is cheaper
+            self._tile_index_cache = index = None
+        if index is not None:
+            self._unindex(index, y*self.width+x, w, h)
+        for attr in self._managers:
+            tiles = getattr(self, attr)
+            src = getattr(layer, attr)
+            if tiles is not None and src is not None:
+                tiles.set_region(self.width, x, y, src, layer.width,
+                                 offset_x+src_x, offset_y+src_y, w, h)
+        if index is not None:
+            self._reindex(index, y*self.width+x, w, h)
+
+    def _resize(self, width, height):
+        w = min(width, self._width)
+        h = min(height, self._height)
+        for attr in self._managers:
+            tiles = getattr(self, attr)
+            if tiles is not None:
+                new_tiles = tiles.empty(width * height)
+                new_tiles.set_region(width, 0, 0, tiles, self._width, 0, 0,
+                                     w, h)
+                setattr(self, attr, new_tiles)
+        self._width = width
+        self._height = height
 
-        for _y in range(tilelayer.height):
-            for _x in range(tilelayer.width):
-                tile = tilelayer.tiles[_y*tilelayer.width+_x]
-                try:
-                    self.tiles[(y+_y)*self.width+(x+_x)] = tile
-                except IndexError:
-                    pass
+    def as_array(self):
+        """Returns the tiles as structured numpy array.
+
+        The array has the shape (height, width) and the fields ``index``,
+        ``flags``, ``skip`` and ``reserved``. It shares memory with the
+        layer, so writing to it changes the tiles. Resizing the layer
+        replaces the tiles, old arrays are not updated anymore.
+
+        :raises: ImportError if numpy is not installed
+
+        """
+        return self.tiles.as_array().reshape(self.height, self.width)
+
+    @property
+    def index_plane(self):
+        """Writable (height, width) numpy view of the tile indices."""
+        return self.as_array()['index']
+
+    @property
+    def flags_plane(self):
+        """Writable (height, width) numpy view of the tile flags."""
+        return self.as_array()['flags']
 
     @property
     def width(self):
@@ -334,17 +826,8 @@ class TileLayer(Layer):
     def width(self, value):
         if value < 0:
             raise ValueError('Value must be positive')
-        if value < self._width:
-            tiles = self.select(0, 0, value, self.height).tiles
-        elif value > self._width:
-            layer = TileLayer(value, self.height)
-            layer.draw(0, 0, self)
-            tiles = layer.tiles
-        else:
-            return
-
-        self._width = value
-        self.tiles = tiles
+        if value != self._width:
+            self._resize(value, self._height)
 
     @property
     def height(self):
@@ -354,17 +837,18 @@ class TileLayer(Layer):
     def height(self, value):
         if value < 0:
             raise ValueError('Value must be positive')
-        if value < self._height:
-            tiles = self.select(0, 0, self.width, value).tiles
-        elif value > self._height:
-            layer = TileLayer(self.width, value)
-            layer.draw(0, 0, self)
-            tiles = layer.tiles
-        else:
-            return
+        if value != self._height:
+            self._resize(self._width, value)
 
-        self._height = value
-        self.tiles = tiles
+    @property
+    def game(self):
+        return self._game
+
+    @game.setter
+    def game(self, value):
+        self._game = value
+        # the role of the layer in the maps which indexed it may change
+        _changed(self)
 
     @property
     def is_gamelayer(self):
@@ -387,6 +871,53 @@ class TileLayer(Layer):
             return '<Speedup layer ({0}x{1})>'.format(self.width, self.height)
         return '<Tilelayer ({0}x{1})>'.format(self.width, self.height)
 
+class TileLayerView(object):
+    """A rectangular window into a :class:`TileLayer`.
+
+    Tiles are read from and written to the layer directly, nothing is
+    copied. Create it with :meth:`TileLayer.view`, a view can be passed to
+    :meth:`TileLayer.draw` like a layer.
+
+    """
+
+    def __init__(self, layer, x, y, width, height):
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def _check_bounds(self, x, y):
+        if not 0 <= x < self.width:
+            raise ValueError('x is out of bounds')
+        if not 0 <= y < self.height:
+            raise ValueError('y is out of bounds')
+
+    def get_tile(self, x, y):
+        """Get a tile by its coordinates in the view."""
+        self._check_bounds(x, y)
+        return self.layer.get_tile(self.x+x, self.y+y)
+
+    def set_tile(self, x, y, tile):
+        """Set a tile by its coordinates in the view."""
+        self._check_bounds(x, y)
+        self.layer.set_tile(self.x+x, self.y+y, tile)
+
+    def __iter__(self):
+        tiles = self.layer.tiles
+        width = self.layer.width
+        for y in xrange(self.y, self.y+self.height):
+            start = y*width+self.x
+            for i in xrange(start, start+self.width):
+                yield tiles[i]
+
+    def __len__(self):
+        return self.width * self.height
+
+    def __repr__(self):
+        return '<TileLayerView ({0}x{1} at {2}:{3})>'.format(self.width,
+                                            self.height, self.x, self.y)
+
 class QuadLayer(Layer):
     """Represents a quadlayer.
 
@@ -401,6 +932,8 @@ class QuadLayer(Layer):
 
     type_size = 10
 
+    quads = lazy_attribute('quads')
+
     def __init__(self, name='Quads', detail=False, image_id=-1, quads=None):
         super(QuadLayer, self).__init__(detail)
         self.name = name
@@ -408,9 +941,38 @@ class QuadLayer(Layer):
         self.quads = quads or QuadManager()
         self.type = 'quadlayer'
 
+    def _num_quads(self):
+        """Returns the number of quads without loading lazy quads."""
+        quads = peek(self, 'quads')
+        if isinstance(quads, LazyData) and quads.size is not None:
+            return quads.size // 152
+        return len(self.quads)
+
+    def fingerprint(self):
+        """Returns a hash of the content of the layer.
+
+        Lazy quads are decompressed for it, but not decoded.
+        """
+        values = ('quads', self.name or '', bool(self.detail), self.image_id,
+                  tuple(self.extra))
+        return fingerprint(values, [peek_raw(self, 'quads',
+                                    lambda quads: ''.join(quads.quads))])
+
     def __repr__(self):
         return '<Quadlayer ({0})>'.format(len(self.quads))
 
+_QUAD_STRUCT = Struct('38i')
+# matches tiles which are not air in a string of tile indices
+_NONEMPTY = re.compile('[^\x00]')
+# tile indices TileLayer.find() keeps an index of: entities, death and nohook
+_INDEXED_VALUES = sorted([index for index in TILEINDEX.values() if index > 1])
+_INDEXED = re.compile('[{0}]'.format(''.join([re.escape(chr(index))
+                                              for index in _INDEXED_VALUES])))
+# draw() drops the tile index instead of updating it for larger areas
+_INDEX_AREA = 64 * 64
+# flags which change how a tile is drawn
+_TRANSFORM_FLAGS = TILEFLAG_VFLIP | TILEFLAG_HFLIP | TILEFLAG_ROTATE
+
 class QuadManager(object):
     """Handles quads while sparing memory.
 
@@ -471,21 +1033,14 @@ class QuadManager(object):
             data.extend(texcoord)
         data.extend([quad.pos_env, quad.pos_env_offset, quad.color_env,
                      quad.color_env_offset])
-        return pack('38i', *data)
+        return _QUAD_STRUCT.pack(*data)
 
     def _string_to_quad(self, string):
-        quad_data = string
-        points = []
-        for l in range(5):
-            points.append(unpack('2i', quad_data[l*8:l*8+8]))
-        colors = []
-        for l in range(4):
-            colors.append(unpack('4i', quad_data[40+l*16:40+l*16+16]))
-        texcoords = []
-        for l in range(4):
-            texcoords.append(unpack('2i', quad_data[104+l*8:104+l*8+8]))
-        pos_env, pos_env_offset, color_env, color_env_offset = unpack('4i',
-                                                            quad_data[136:152])
+        values = _QUAD_STRUCT.unpack(string)
+        points = [values[i:i+2] for i in range(0, 10, 2)]
+        colors = [values[i:i+4] for i in range(10, 26, 4)]
+        texcoords = [values[i:i+2] for i in range(26, 34, 2)]
+        pos_env, pos_env_offset, color_env, color_env_offset = values[34:]
         return Quad(pos_env=pos_env, pos_env_offset=pos_env_offset,
                     color_env=color_env, color_env_offset=color_env_offset,
                     points=points, colors=colors, texcoords=texcoords)
@@ -498,6 +1053,9 @@ class Quad(object):
 
     """
 
+    __slots__ = ('pos_env', 'pos_env_offset', 'color_env', 'color_env_offset',
+                 'points', 'colors', 'texcoords')
+
     def __init__(self, pos_env=-1, pos_env_offset=0, color_env=-1,
                  color_env_offset=0, points=None, colors=None, texcoords=None):
         self.pos_env = pos_env
@@ -523,7 +1081,8 @@ class Quad(object):
 class TileManager(object):
     """Handles tiles while sparing memory.
 
-    Keeps track of tiles as simple strings, but returns a Tile class on demand.
+    Keeps track of tiles in one contiguous buffer of raw tile data, but
+    returns a Tile class on demand.
 
     .. note::
 
@@ -544,38 +1103,161 @@ class TileManager(object):
 
     :param size: Fill up the manager with n empty tiles.
     :param tiles: List of tiles to put in.
-    :param data: Raw tile data, used internally.
+    :param data: Raw tile data, used internally. A bytearray is used as it
+                 is, everything else is copied into a new one.
     :param _type: Used for a race modification, you probably don't need it
     """
 
+    # size of one tile in bytes per type
+    tile_sizes = (4, 2, 4)
+    # numpy dtypes of the raw data per type
+    dtypes = (
+        [('index', 'u1'), ('flags', 'u1'), ('skip', 'u1'), ('reserved', 'u1')],
+        [('number', 'u1'), ('type', 'u1')],
+        [('force', 'u1'), ('reserved', 'u1'), ('angle', 'i2')],
+    )
+
     def __init__(self, size=0, tiles=None, data=None, _type=0):
         self.type = _type
+        self.tile_size = self.tile_sizes[_type]
+        # increased on every change through the manager, so layers know if
+        # their index of the tiles is outdated
+        self._revision = 0
+        # changes through numpy arrays can't be noticed
+        self._exported = False
         if tiles is not None:
-            self.tiles = [self._tile_to_string(tile) for tile in tiles]
+            self.data = bytearray(''.join([self._tile_to_string(tile)
+                                           for tile in tiles]))
+        elif isinstance(data, bytearray):
+            self.data = data
         elif data is not None:
-            self.tiles = data
+            self.data = bytearray(data)
         else:
-            self.tiles = ['\x00\x00\x00\x00'] * size
+            self.data = bytearray(size * self.tile_size)
 
     def __getitem__(self, value):
+        size = self.tile_size
         if isinstance(value, slice):
-            return TileManager(data=self.tiles[value])
+            start, stop, step = value.indices(len(self))
+            if step == 1:
+                data = self.data[start*size:max(start, stop)*size]
+            else:
+                data = bytearray().join([self.data[i*size:i*size+size]
+                                         for i in xrange(start, stop, step)])
+            return TileManager(data=data, _type=self.type)
+        if value < 0:
+            value += len(self)
+        if not 0 <= value < len(self):
+            raise IndexError('TileManager index out of range')
+        if self.type == 0:
+            data = self.data
+            i = value * 4
+            return Tile(data[i], data[i+1], data[i+2], data[i+3])
+        string = str(self.data[value*size:value*size+size])
         if self.type == 1:
-            return TeleTile(self.tiles[value])
-        if self.type == 2:
-            return SpeedupTile(self.tiles[value])
-        return self._string_to_tile(self.tiles[value])
+            return TeleTile(*TeleTileManager.record.unpack(string))
+        return SpeedupTile(*SpeedupTileManager.record.unpack(string))
+
+    def empty(self, size):
+        """Returns a new manager of the same type with `size` empty tiles."""
+        return TileManager(size, _type=self.type)
+
+    def frozen(self, value):
+        """Returns the tile at index `value` as shared :class:`FrozenTile`.
+
+        Reading tiles this way allocates nothing for tiles which were read
+        before, use :meth:`FrozenTile.copy` to get a tile you can change.
+        Only for tiles, not for tele or speedup tiles.
+
+        """
+        if self.type != 0:
+            raise TypeError('Only tiles can be frozen')
+        if value < 0:
+            value += len(self)
+        if not 0 <= value < len(self):
+            raise IndexError('TileManager index out of range')
+        return FrozenTile.get(self.data[value*4:value*4+4])
 
     def __setitem__(self, k, v):
+        size = self.tile_size
         if isinstance(v, str):
-            if len(v) != 4:
-                raise ValueError('The string must be exactly 4 chars long.')
-            self.tiles[k] = v
+            if len(v) != size:
+                raise ValueError('The string must be exactly {0} chars '
+                                 'long.'.format(size))
         else:
-            self.tiles[k] = self._tile_to_string(v)
+            v = self._tile_to_string(v)
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('TileManager index out of range')
+        self.data[k*size:k*size+size] = v
+        self._revision += 1
 
     def __len__(self):
-        return len(self.tiles)
+        return len(self.data) // self.tile_size
+
+    def __iter__(self):
+        if self.type != 0:
+            for i in xrange(len(self)):
+                yield self[i]
+            return
+        data = self.data
+        for i in xrange(0, len(data), 4):
+            yield Tile(data[i], data[i+1], data[i+2], data[i+3])
+
+    def get_region(self, width, x, y, w, h):
+        """Returns a new manager with the tiles of an area.
+
+        The area is not clipped, it has to fit into the layer.
+
+        :param width: Width of the layer the tiles belong to
+        :returns: TileManager
+
+        """
+        size = self.tile_size
+        if w == width:
+            data = self.data[y*width*size:(y+h)*width*size]
+        else:
+            data = bytearray().join([
+                self.data[((y+i)*width+x)*size:((y+i)*width+x+w)*size]
+                for i in xrange(h)
+            ])
+        return TileManager(data=data, _type=self.type)
+
+    def set_region(self, width, x, y, src, src_width, src_x, src_y, w, h):
+        """Copies an area of another manager row by row into this one.
+
+        The area is not clipped, it has to fit into both layers.
+
+        :param width: Width of the layer the tiles belong to
+        :param src: TileManager of the same type to copy from
+        :param src_width: Width of the layer `src` belongs to
+
+        """
+        size = self.tile_size
+        src_data = src.data
+        if src_data is self.data:
+            # copying inside the same buffer might overlap
+            src_data = src_data[:]
+        row = w * size
+        for i in xrange(h):
+            start = ((y+i)*width+x)*size
+            src_start = ((src_y+i)*src_width+src_x)*size
+            self.data[start:start+row] = buffer(src_data, src_start, row)
+        self._revision += 1
+
+    def as_array(self):
+        """Returns a structured numpy array sharing memory with the tiles.
+
+        Writing to the array changes the tiles.
+
+        :raises: ImportError if numpy is not installed
+
+        """
+        if numpy is None:
+            raise ImportError('as_array() requires numpy')
+        self._exported = True
+        return numpy.frombuffer(self.data, dtype=self.dtypes[self.type])
 
     def _tile_to_string(self, tile):
         return pack('4B', tile.index, tile._flags, tile.skip, tile.reserved)
@@ -590,22 +1272,28 @@ class TileManager(object):
 class Tile(object):
     """Represents a tile of a tilelayer."""
 
+    __slots__ = ('index', '_flags', 'skip', 'reserved')
+
     def __init__(self, index=0, flags=0, skip=0, reserved=0):
         self.index = index
         self._flags = flags
         self.skip = skip
         self.reserved = reserved
 
+    def copy(self):
+        """Returns a new :class:`Tile` with the same values."""
+        return Tile(self.index, self._flags, self.skip, self.reserved)
+
     def vflip(self):
         """Flip the tile in vertical direction"""
-        if self.flags['rotation']:
+        if self._flags & TILEFLAG_ROTATE:
             self._flags ^= TILEFLAG_HFLIP
         else:
             self._flags ^= TILEFLAG_VFLIP
 
     def hflip(self):
         """Flip the tile in horizontal direction"""
-        if self.flags['rotation']:
+        if self._flags & TILEFLAG_ROTATE:
             self._flags ^= TILEFLAG_VFLIP
         else:
             self._flags ^= TILEFLAG_HFLIP
@@ -619,11 +1307,11 @@ class Tile(object):
 
         """
         if value.lower() in ('r', 'right'):
-            if self.flags['rotation']:
+            if self._flags & TILEFLAG_ROTATE:
                 self._flags ^= (TILEFLAG_HFLIP|TILEFLAG_VFLIP)
             self._flags ^= TILEFLAG_ROTATE
         elif value.lower() in ('l', 'left'):
-            if self.flags['rotation']:
+            if self._flags & TILEFLAG_ROTATE:
                 self._flags ^= (TILEFLAG_HFLIP|TILEFLAG_VFLIP)
             self._flags ^= TILEFLAG_ROTATE
             self.vflip()
@@ -657,14 +1345,64 @@ class Tile(object):
         return '<Tile ({0})>'.format(self.index)
 
     def __eq__(self, other):
-        return self.index == other.index and self.flags == other.flags and \
+        # like the flags property, the opaque flag is ignored
+        return self.index == other.index and \
+           (self._flags ^ other._flags) & _TRANSFORM_FLAGS == 0 and \
            self.skip == other.skip and self.reserved == other.reserved
 
+    def __ne__(self, other):
+        return not self == other
+
+class FrozenTile(Tile):
+    """Immutable :class:`Tile`, shared by all tiles with the same values.
+
+    Returned by :meth:`TileManager.frozen`, don't create it yourself. Use
+    :meth:`copy` to get a tile which can be changed.
+
+    """
+
+    __slots__ = ()
+
+    # frozen tiles by their raw data
+    _cache = {}
+    _cache_size = 65536
+
+    @classmethod
+    def get(cls, data):
+        """Returns the frozen tile for 4 bytes of raw tile data."""
+        key = str(data)
+        tile = cls._cache.get(key)
+        if tile is None:
+            if len(cls._cache) >= cls._cache_size:
+                cls._cache.clear()
+            tile = cls._cache[key] = cls(*bytearray(data))
+        return tile
+
+    def __init__(self, index=0, flags=0, skip=0, reserved=0):
+        set_ = super(FrozenTile, self).__setattr__
+        set_('index', index)
+        set_('_flags', flags)
+        set_('skip', skip)
+        set_('reserved', reserved)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenTile is immutable, use copy()')
+
+    def __hash__(self):
+        return hash((self.index, self._flags & _TRANSFORM_FLAGS, self.skip,
+                     self.reserved))
+
+    def __repr__(self):
+        return '<FrozenTile ({0})>'.format(self.index)
+
 class TeleTile(object):
     """Represents a tele tile of a tilelayer. Only for race modification."""
 
-    def __init__(self, data):
-        self.number, self.type = unpack('2B', data)
+    __slots__ = ('number', 'type')
+
+    def __init__(self, number=0, type=0):
+        self.number = number
+        self.type = type
 
     def __repr__(self):
         return '<TeleTile ({0})>'.format(self.number)
@@ -672,8 +1410,205 @@ class TeleTile(object):
 class SpeedupTile(object):
     """Represents a speedup tile of a tilelayer. Only for race modification."""
 
-    def __init__(self, data):
-        self.force, self.angle = unpack('Bh', data)
+    __slots__ = ('force', 'angle')
+
+    def __init__(self, force=0, angle=0):
+        self.force = force
+        self.angle = angle
+
+    def __repr__(self):
+        return '<SpeedupTile ({0})>'.format(self.force)
+
+class ColumnTileManager(object):
+    """Handles special tiles with one typed array per field.
+
+    Base class for the managers of the layers of modifications. The raw
+    tile data is split into columns when it is loaded, so whole columns can
+    be read, written and handed to numpy without touching single tiles.
+    Subclasses describe the raw tile data with `record` and `columns`.
+
+    :param size: Fill up the manager with n empty tiles.
+    :param data: Raw tile data, used internally.
+    :param columns: Initial values of the columns by their name.
+    """
+
+    # struct of the raw data of one tile, with the fields in column order
+    record = None
+    # name, array typecode and offset in the raw data of every column
+    columns = ()
+    # class of the tiles returned by __getitem__
+    tile_class = None
+
+    def __init__(self, size=0, data=None, **columns):
+        self.tile_size = self.record.size
+        self.arrays = {}
+        if data is not None:
+            self._decode(data)
+        elif columns:
+            for name, typecode, offset in self.columns:
+                self.arrays[name] = array(typecode, columns[name])
+        else:
+            for name, typecode, offset in self.columns:
+                self.arrays[name] = array(typecode, [0]) * size
+
+    def _decode(self, data):
+        data = bytearray(data)
+        size = self.tile_size
+        num = len(data) // size
+        del data[num*size:]
+        for name, typecode, offset in self.columns:
+            column = array(typecode)
+            itemsize = column.itemsize
+            raw = bytearray(num * itemsize)
+            for i in range(itemsize):
+                raw[i::itemsize] = data[offset+i::size]
+            column.fromstring(str(raw))
+            if sys.byteorder == 'big' and itemsize > 1:
+                column.byteswap()
+            self.arrays[name] = column
+
+    @property
+    def data(self):
+        """The raw tile data as it is saved in the map."""
+        size = self.tile_size
+        data = bytearray(len(self) * size)
+        for name, typecode, offset in self.columns:
+            column = self.arrays[name]
+            itemsize = column.itemsize
+            if sys.byteorder == 'big' and itemsize > 1:
+                column = array(typecode, column)
+                column.byteswap()
+            raw = bytearray(column.tostring())
+            for i in range(itemsize):
+                data[offset+i::size] = raw[i::itemsize]
+        return data
+
+    def __len__(self):
+        return len(self.arrays[self.columns[0][0]])
+
+    def __iter__(self):
+        tile_class = self.tile_class
+        columns = [self.arrays[name] for name, typecode, offset in self.columns]
+        for values in izip(*columns):
+            yield tile_class(*values)
+
+    def __getitem__(self, value):
+        if isinstance(value, slice):
+            return self.__class__(**dict([(name, column[value])
+                                  for name, column in self.arrays.items()]))
+        if value < 0:
+            value += len(self)
+        if not 0 <= value < len(self):
+            raise IndexError('{0} index out of range'.format(
+                             self.__class__.__name__))
+        return self.tile_class(*[self.arrays[name][value]
+                                 for name, typecode, offset in self.columns])
+
+    def __setitem__(self, k, v):
+        if isinstance(v, str):
+            if len(v) != self.tile_size:
+                raise ValueError('The string must be exactly {0} chars '
+                                 'long.'.format(self.tile_size))
+            values = self.record.unpack(v)
+        else:
+            values = [getattr(v, name) for name, typecode, offset
+                      in self.columns]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('{0} index out of range'.format(
+                             self.__class__.__name__))
+        for (name, typecode, offset), value in zip(self.columns, values):
+            self.arrays[name][k] = value
+
+    def get_column(self, name):
+        """Returns a copy of a whole column as :class:`array.array`."""
+        return array(self.arrays[name].typecode, self.arrays[name])
+
+    def set_column(self, name, values):
+        """Replaces the values of a whole column.
+
+        :param values: Sequence with one value per tile.
+        :raises: ValueError if the number of values is wrong.
+        """
+        if len(values) != len(self):
+            raise ValueError('Expected {0} values'.format(len(self)))
+        column = self.arrays[name]
+        column[:] = array(column.typecode, values)
+
+    def empty(self, size):
+        """Returns a new manager of the same type with `size` empty tiles."""
+        return self.__class__(size)
+
+    def get_region(self, width, x, y, w, h):
+        """Returns a new manager with the tiles of an area.
+
+        See :meth:`TileManager.get_region`.
+        """
+        columns = {}
+        for name, column in self.arrays.items():
+            if w == width:
+                columns[name] = column[y*width:(y+h)*width]
+            else:
+                region = array(column.typecode)
+                for i in xrange(h):
+                    start = (y+i)*width + x
+                    region.extend(column[start:start+w])
+                columns[name] = region
+        return self.__class__(**columns)
+
+    def set_region(self, width, x, y, src, src_width, src_x, src_y, w, h):
+        """Copies an area of another manager row by row into this one.
+
+        See :meth:`TileManager.set_region`.
+        """
+        for name, column in self.arrays.items():
+            src_column = src.arrays[name]
+            if src_column is column:
+                # copying inside the same array might overlap
+                src_column = column[:]
+            for i in xrange(h):
+                start = (y+i)*width + x
+                src_start = (src_y+i)*src_width + src_x
+                column[start:start+w] = src_column[src_start:src_start+w]
+
+    def as_array(self, name=None):
+        """Returns numpy arrays sharing memory with the columns.
+
+        Writing to the arrays changes the tiles.
+
+        :param name: Name of a column. If it is not given, a dict with the
+                     arrays of all columns is returned.
+        :raises: ImportError if numpy is not installed
+        """
+        if numpy is None:
+            raise ImportError('as_array() requires numpy')
+        if name is not None:
+            column = self.arrays[name]
+            return numpy.frombuffer(column, dtype=column.typecode)
+        return dict([(name, self.as_array(name))
+                     for name, typecode, offset in self.columns])
 
     def __repr__(self):
-        return '<SpeedupTile ({0})>'.format(self.index)
+        return '<{0} ({1})>'.format(self.__class__.__name__, len(self))
+
+class TeleTileManager(ColumnTileManager):
+    """Handles the tele tiles of a telelayer. Only for race modification.
+
+    The columns are ``number`` and ``type``.
+    """
+
+    record = Struct('<BB')
+    columns = (('number', 'B', 0), ('type', 'B', 1))
+    tile_class = TeleTile
+
+class SpeedupTileManager(ColumnTileManager):
+    """Handles the speedup tiles of a speeduplayer. Only for race
+    modification.
+
+    The columns are ``force`` and ``angle``.
+    """
+
+    record = Struct('<Bxh')
+    columns = (('force', 'B', 0), ('angle', 'h', 2))
+    tile_class = SpeedupTile
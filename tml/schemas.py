@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    Layouts of the items in a datafile, shared by the reader and the writer.
+
+    :copyright: 2010-2011 by the TML Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+from struct import Struct
+
+from utils import ints_to_string, string_to_ints
+
+_structs = {}
+
+def int_struct(num):
+    """Returns a precompiled :class:`struct.Struct` for `num` ints."""
+    struct = _structs.get(num)
+    if struct is None:
+        struct = _structs[num] = Struct('{0}i'.format(num))
+    return struct
+
+class Field(object):
+    """A field of an item.
+
+    :param name: Name of the field.
+    :param count: Number of ints the field consists of. Fields with more
+                  than one int are decoded as tuple.
+    :param string: ``True`` if the ints hold a string.
+    :param default: Value of the field if the item is too old to have it.
+    """
+
+    def __init__(self, name, count=1, string=False, default=None):
+        self.name = name
+        self.count = count
+        self.string = string
+        self.default = default
+
+    def decode(self, ints, offset):
+        if self.string:
+            return ints_to_string(ints[offset:offset+self.count])
+        if self.count == 1:
+            return ints[offset]
+        return ints[offset:offset+self.count]
+
+    def encode(self, value):
+        if self.string:
+            return string_to_ints(value, self.count)
+        if self.count == 1:
+            return [value]
+        return list(value)
+
+    def __repr__(self):
+        return '<Field ({0})>'.format(self.name)
+
+class Schema(object):
+    """Layout of an item type.
+
+    Newer versions of an item type only append fields, so every version
+    knows the first fields of the list. Ints after the known fields are
+    kept as ``extra``.
+
+    :param fields: List of :class:`Field` or names of single int fields.
+    :param versions: Dict mapping a version to the number of fields it has
+                     and every later version has as well. All fields are
+                     known if it is not given.
+    :param version_field: Name of the field with the version, ``None`` if
+                          the item type has no version.
+    """
+
+    def __init__(self, fields, versions=None, version_field='version'):
+        self.fields = [field if isinstance(field, Field) else Field(field)
+                       for field in fields]
+        self.offsets = []
+        offset = 0
+        for field in self.fields:
+            self.offsets.append(offset)
+            offset += field.count
+        self.offsets.append(offset)
+        # number of ints of all fields
+        self.size = offset
+        self.struct = int_struct(self.size)
+        self.versions = sorted((versions or {}).items())
+        self.version_field = version_field
+        self.version_offset = None
+        for field, offset in zip(self.fields, self.offsets):
+            if field.name == version_field:
+                self.version_offset = offset
+
+    def num_fields(self, version=None):
+        """Returns the number of fields items of `version` have."""
+        num = len(self.fields)
+        if version is None or not self.versions:
+            return num
+        num = self.versions[0][1]
+        for since, num_fields in self.versions:
+            if version >= since:
+                num = num_fields
+        return num
+
+    def decode(self, data, size=None):
+        """Decodes an item.
+
+        :param data: Buffer or string with the item data.
+        :param size: Size of the item in bytes, defaults to ``len(data)``.
+        :returns: dict with the fields. Fields the item is too old for get
+                  their default, the ints after the known fields are in
+                  ``extra``.
+        """
+        if size is None:
+            size = len(data)
+        if size == self.size*4:
+            ints = self.struct.unpack_from(data)
+        else:
+            ints = int_struct(size // 4).unpack_from(data)
+        return self.decode_ints(ints)
+
+    def decode_ints(self, ints):
+        """Decodes an item from its ints, see :meth:`decode`."""
+        version = None
+        if self.version_offset is not None and \
+           self.version_offset < len(ints):
+            version = ints[self.version_offset]
+        num = self.num_fields(version)
+        item = {}
+        for field, offset in zip(self.fields[:num], self.offsets):
+            if offset + field.count <= len(ints):
+                item[field.name] = field.decode(ints, offset)
+            else:
+                item[field.name] = field.default
+        for field in self.fields[num:]:
+            item[field.name] = field.default
+        item['extra'] = ints[self.offsets[num]:]
+        return item
+
+    def iter_decode(self, data, size=None):
+        """Decodes an item which is an array of records of this schema."""
+        if size is None:
+            size = len(data)
+        step = self.size * 4
+        for offset in xrange(0, size - step + 1, step):
+            yield self.decode_ints(self.struct.unpack_from(data, offset))
+
+    def encode(self, item, extra=()):
+        """Encodes an item.
+
+        Only the fields of the version in `item` are written.
+
+        :param item: dict with the fields.
+        :param extra: Ints written after the known fields.
+        """
+        version = None
+        if self.version_field is not None:
+            version = item[self.version_field]
+        ints = []
+        for field in self.fields[:self.num_fields(version)]:
+            ints.extend(field.encode(item[field.name]))
+        ints.extend(extra)
+        if len(ints) == self.size:
+            return self.struct.pack(*ints)
+        return int_struct(len(ints)).pack(*ints)
+
+    def encode_all(self, items):
+        """Encodes a list of records as one array item."""
+        return ''.join([self.encode(item) for item in items])
+
+_LAYER_FIELDS = ['layer_version', 'type', 'flags']
+
+VERSION = Schema(['version'])
+INFO = Schema(['version', 'author', 'map_version', 'credits', 'license',
+               Field('settings', default=-1)])
+IMAGE = Schema(['version', 'width', 'height', 'external', 'name', 'data'])
+ENVELOPE = Schema(['version', 'channels', 'start_point', 'num_points',
+                   Field('name', 8, string=True)])
+ENVPOINT = Schema(['time', 'curvetype', Field('values', 4)],
+                  version_field=None)
+GROUP = Schema(['version', 'offset_x', 'offset_y', 'parallax_x',
+                'parallax_y', 'start_layer', 'num_layers',
+                Field('use_clipping', default=0), Field('clip_x', default=0),
+                Field('clip_y', default=0), Field('clip_w', default=0),
+                Field('clip_h', default=0), Field('name', 3, string=True)],
+               versions={1: 7, 2: 12, 3: 13})
+LAYER = Schema(_LAYER_FIELDS, version_field=None)
+TILELAYER = Schema(_LAYER_FIELDS + ['version', 'width', 'height', 'game',
+                   Field('color', 4), 'color_env', 'color_env_offset',
+                   'image_id', 'data', Field('name', 3, string=True)],
+                   versions={0: 12, 3: 13})
+QUADLAYER = Schema(_LAYER_FIELDS + ['version', 'num_quads', 'data',
+                   'image_id', Field('name', 3, string=True)],
+                   versions={0: 7, 2: 8})
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import warnings
+
+from analysis import RegionMap
+from items import TileLayer, Tile
+from tml import Teemap
+
+class TestRegionMap(unittest.TestCase):
+
+    def setUp(self):
+        rows = ['1111111',
+                '1s01001',
+                '1001021',
+                '1111331',
+                '0000000']
+        self.layer = TileLayer(7, 5, game=1)
+        for y, row in enumerate(rows):
+            for x, kind in enumerate(row):
+                index = 192 if kind == 's' else int(kind)
+                self.layer.set_tile(x, y, Tile(index))
+        self.regions = RegionMap(self.layer)
+
+    def test_regions(self):
+        self.assertEqual(len(self.regions), 6)
+        self.assertEqual([region.kind for region in self.regions],
+                         ['solid', 'air', 'air', 'death', 'nohook', 'air'])
+        self.assertEqual(sum(region.size for region in self.regions), 35)
+        solid = self.regions[0]
+        self.assertEqual(solid.size, 18)
+        self.assertEqual(solid.bbox, (0, 0, 7, 4))
+        self.assertTrue(solid.touches_border)
+        room = self.regions.region_at(2, 2)
+        self.assertIs(room, self.regions[1])
+        self.assertEqual(room.size, 4)
+        self.assertEqual(room.bbox, (1, 1, 2, 2))
+        self.assertFalse(room.touches_border)
+        self.assertEqual(self.regions.by_kind('death'), [self.regions[3]])
+        self.assertRaises(ValueError, self.regions.region_at, 7, 0)
+
+    def test_neighbours(self):
+        self.assertEqual(self.regions[1].neighbours, set([0]))
+        self.assertEqual(self.regions[2].neighbours, set([0, 3, 4]))
+        self.assertEqual(self.regions[5].neighbours, set([0, 4]))
+
+    def test_spawns(self):
+        self.assertEqual(self.regions[1].spawns, [(1, 1)])
+        self.assertEqual(self.regions.spawn_regions(), [self.regions[1]])
+        self.assertEqual(self.regions.pockets(),
+                         [self.regions[5], self.regions[2]])
+
+    def test_vanilla(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            teemap = Teemap('tml/test_maps/vanilla')
+        gamelayer = teemap.gamelayer
+        regions = RegionMap(gamelayer)
+        self.assertEqual(sum(region.size for region in regions),
+                         gamelayer.width * gamelayer.height)
+        spawns = sum([len(gamelayer.find(name)) for name in
+                      ('spawn', 'spawn_red', 'spawn_blue')])
+        self.assertEqual(sum([len(region.spawns) for region in regions]),
+                         spawns)
+        for region in regions.spawn_regions():
+            self.assertEqual(region.kind, 'air')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import shutil
+import unittest
+from zlib import crc32, decompress
+
+from constants import COMPRESSION_PROFILES, COMPRESSION_SMALL_SIZE, \
+     ITEM_LAYER
+import datafile
+from datafile import DataFileReader, DataFileWriter, crc, scan
+import items
+from tml import Teemap
+
+class TestDataFileReader(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = DataFileReader('tml/test_maps/vanilla', lazy=True)
+
+    def test_mmap(self):
+        self.assertTrue(isinstance(self.reader.data, mmap.mmap))
+        size, item = self.reader.find_item(ITEM_LAYER, 0)
+        self.assertTrue(isinstance(item, buffer))
+        self.assertEqual(len(item), size)
+        data = self.reader.get_compressed_data(0)
+        self.assertTrue(isinstance(data, buffer))
+        self.assertEqual(decompress(data), 'grass_main\x00')
+
+    def test_close(self):
+        with DataFileReader('tml/test_maps/vanilla', lazy=True) as reader:
+            data = reader.get_compressed_data(0)
+            self.assertEqual(decompress(data), 'grass_main\x00')
+        self.assertEqual(reader._mapping, None)
+        self.assertRaises(TypeError, decompress, data)
+        mappings = datafile._mappings[os.path.realpath(
+                                      'tml/test_maps/vanilla.map')]
+        self.assertFalse(reader.data in mappings)
+
+    def test_metadata(self):
+        metadata = scan('tml/test_maps/vanilla')
+        self.assertEqual(metadata['name'], 'vanilla')
+        self.assertEqual(metadata['author'], None)
+        self.assertEqual(metadata['num_groups'], 7)
+        self.assertEqual(metadata['num_layers'], 6)
+        self.assertEqual((metadata['width'], metadata['height']), (50, 50))
+        self.assertEqual([image['name'] for image in metadata['images']],
+                         ['grass_main', 'test', 'test2'])
+        self.assertEqual([image['external'] for image in metadata['images']],
+                         [True, False, True])
+        self.assertEqual(metadata['images'][1]['width'], 1024)
+        self.assertEqual(metadata, self.reader.metadata())
+
+    def test_crc(self):
+        with open('tml/test_maps/vanilla.map', 'rb') as f:
+            data = f.read()
+        expected = (crc32(data) & 0xffffffff, len(data))
+        self.assertEqual(crc('tml/test_maps/vanilla'), expected)
+        with open('tml/test_maps/vanilla.map', 'rb') as f:
+            self.assertEqual(crc(f), expected)
+
+    def test_info(self):
+        os.mkdir('test_tmp')
+        try:
+            teemap = Teemap('tml/test_maps/vanilla')
+            teemap.info = items.Info(author='erdbeere', license='GPL',
+                                     settings=['sv_gametype ctf'])
+            teemap.save('test_tmp/info.map')
+            metadata = scan('test_tmp/info.map')
+            self.assertEqual(metadata['author'], 'erdbeere')
+            self.assertEqual(metadata['license'], 'GPL')
+            self.assertEqual(metadata['credits'], None)
+            info = Teemap('test_tmp/info').info
+            self.assertEqual(info.author, 'erdbeere')
+            self.assertEqual(info.map_version, None)
+            self.assertEqual(info.settings, ['sv_gametype ctf'])
+        finally:
+            shutil.rmtree('test_tmp')
+
+    def test_workers(self):
+        reader = DataFileReader('tml/test_maps/vanilla', workers=4)
+        self.assertEqual(reader._decompressed, {})
+        serial = DataFileReader('tml/test_maps/vanilla')
+        for layer, serial_layer in zip(reader.groups[2].layers +
+                                       reader.groups[4].layers,
+                                       serial.groups[2].layers +
+                                       serial.groups[4].layers):
+            self.assertEqual(layer.tiles.data, serial_layer.tiles.data)
+        self.assertEqual(reader.images[1].data, serial.images[1].data)
+        self.assertEqual(sorted(reader._data_indices()), [2, 4, 5, 6, 7, 8, 9])
+
+    def test_lazy_data(self):
+        layer = self.reader.groups[2].layers[0]
+        self.assertTrue(isinstance(layer._tiles.data, buffer))
+
+class TestDataFileWriter(unittest.TestCase):
+
+    def test_compression_settings(self):
+        small = DataFileWriter.DataFileData('x' * COMPRESSION_SMALL_SIZE)
+        large = DataFileWriter.DataFileData('x' * (COMPRESSION_SMALL_SIZE+1))
+        for compression in COMPRESSION_PROFILES:
+            # only large data parts depend on the profile
+            self.assertEqual(small.compression_settings(compression), (6, 8))
+        self.assertEqual(large.compression_settings('fast'), (1, 8))
+        self.assertEqual(large.compression_settings('max'), (9, 9))
+
+if __name__ == '__main__':
+    unittest.main()
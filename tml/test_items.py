@@ -2,8 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from items import Layer, TileLayer, TileManager, Tile, QuadLayer, QuadManager, \
-     Quad
+from items import Layer, TileLayer, TileLayerView, TileManager, Tile, \
+     QuadLayer, QuadManager, Quad, TeleTileManager, SpeedupTileManager, \
+     SpeedupTile
+from constants import TILEFLAG_HFLIP
+import items
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class TestTileLayer(unittest.TestCase):
 
@@ -164,10 +171,271 @@ class TestTileLayer(unittest.TestCase):
         self.assertEqual(self.layer.get_tile(49, 48).index, 10)
         self.assertEqual(self.layer.get_tile(49, 49).index, 0)
 
+        # assert clipping at negative offsets
+        self.layer.draw(-9, -4, layer)
+        self.assertEqual(self.layer.get_tile(0, 0).index, 10)
+        self.assertEqual(self.layer.get_tile(1, 0).index, 0)
+        self.assertEqual(self.layer.get_tile(0, 1).index, 0)
+
+        # drawing a layer onto itself
+        self.layer.draw(1, 1, self.layer)
+        self.assertEqual(self.layer.get_tile(1, 1).index, 10)
+        self.assertEqual(self.layer.get_tile(21, 1).index, 1)
+        self.assertEqual(self.layer.get_tile(21, 2).index, 1)
+
+    def test_view(self):
+        view = self.layer.view(43, 0, 5, 6)
+        self.assertTrue(isinstance(view, TileLayerView))
+        self.assertEqual(len(view), 30)
+        self.assertEqual([tile.index for tile in view],
+                         [tile.index for tile in self.layer.select(43, 0, 5, 6).tiles])
+        self.assertEqual(view.get_tile(1, 4).index, 1)
+        self.assertRaises(ValueError, view.get_tile, 5, 0)
+        self.assertRaises(ValueError, view.set_tile, 0, 6, Tile(1))
+
+        view.set_tile(0, 1, Tile(12))
+        self.assertEqual(self.layer.get_tile(43, 1).index, 12)
+        self.layer.set_tile(44, 2, Tile(13))
+        self.assertEqual(view.get_tile(1, 2).index, 13)
+
+        # clamping like select
+        view = self.layer.view(45, 47, 10, 10)
+        self.assertEqual((view.x, view.y, view.width, view.height),
+                         (45, 47, 5, 3))
+
+        # draw from a view
+        layer = TileLayer(10, 10)
+        layer.draw(-1, 2, self.layer.view(42, 0, 4, 2))
+        self.assertEqual([layer.get_tile(i, 2).index for i in range(4)],
+                         [1, 1, 0, 0])
+        self.assertEqual([layer.get_tile(i, 3).index for i in range(4)],
+                         [12, 0, 0, 0])
+
+    def test_iter_tiles(self):
+        tiles = list(self.layer.iter_tiles())
+        self.assertEqual(len(tiles), 2500)
+        self.assertEqual(tiles[70], (20, 1, Tile(1)))
+        self.assertEqual(tiles[71][2], Tile())
+        self.assertEqual(len(list(self.layer.iter_rows())), 50)
+        row = list(self.layer.iter_rows())[4]
+        self.assertEqual(list(row[0::4][38:]), [0, 0] + [1] * 10)
+        self.assertEqual(list(self.layer.tiles), [tile for x, y, tile in tiles])
+
+    def test_iter_nonempty(self):
+        tiles = list(self.layer.iter_nonempty())
+        self.assertEqual(len(tiles), 26)
+        self.assertEqual(tiles[:3], [(20, 0, Tile(1)), (40, 0, Tile(1)),
+                                     (41, 0, Tile(1))])
+        frozen = list(self.layer.iter_nonempty(frozen=True))
+        self.assertIs(frozen[0][2], frozen[1][2])
+        self.assertEqual(frozen, tiles)
+
+    def test_find(self):
+        self.assertEqual(len(self.layer.find(1)), 26)
+        self.assertEqual(self.layer.find('solid')[:2], [(20, 0), (40, 0)])
+        self.assertEqual(self.layer.find('spawn'), [])
+        self.assertEqual(len(self.layer.find('air')), 2500 - 26)
+
+        # the index is kept up to date
+        self.layer.set_tile(3, 4, Tile(192))
+        self.layer.set_tile(20, 0, Tile(192))
+        self.assertEqual(self.layer.find('spawn'), [(20, 0), (3, 4)])
+        self.assertEqual(len(self.layer.find(1)), 25)
+        selection = self.layer.select(0, 0, 5, 5)
+        self.layer.draw(40, 0, selection)
+        self.assertEqual(self.layer.find(192), [(20, 0), (3, 4), (43, 4)])
+        self.assertEqual(len(self.layer.find(1)), 15)
+        # changes without set_tile and draw are noticed as well
+        # only entities, death and nohook tiles are indexed
+        self.assertEqual(self.layer._tile_index().keys(), [192])
+        self.layer.set_tile(3, 4, Tile(2))
+        self.layer.draw(0, 1, self.layer.select(0, 0, 50, 5))
+        self.assertEqual(self.layer.find(192), [(20, 0), (20, 1), (43, 5)])
+        self.assertEqual(self.layer.find('death'), [(3, 5)])
+        index = self.layer._tile_index()
+        self.layer._tile_index_cache = None
+        self.assertEqual(self.layer._tile_index(), index)
+        # without numpy the same index is built
+        numpy, items.numpy = items.numpy, None
+        try:
+            self.layer._tile_index_cache = None
+            self.assertEqual(self.layer._tile_index(), index)
+        finally:
+            items.numpy = numpy
+        self.layer.tiles[0] = Tile(2)
+        self.assertEqual(self.layer.find('death'), [(0, 0), (3, 5)])
+        self.layer.width = 10
+        self.assertEqual(self.layer.find(2), [(0, 0), (3, 5)])
+
+    def test_stats(self):
+        stats = self.layer.stats()
+        self.assertEqual(stats['histogram'], {0: 2474, 1: 26})
+        self.assertEqual(stats['flags'], {0: 26})
+        self.assertEqual(stats['bbox'], (2, 0, 48, 50))
+        self.assertEqual(stats['fill'], 26 / 2500.0)
+        self.assertEqual(stats['rows'][:6], [6, 1, 0, 0, 10, 1])
+        self.assertEqual(stats['rows'][48:], [2, 1])
+        self.assertEqual(stats['columns'][40:46], [2, 2, 2, 2, 2, 7])
+        self.assertIs(self.layer.stats(), stats)
+
+        # both ways to count give the same numbers
+        python_stats = self.layer._python_stats()
+        for key in ('histogram', 'flags', 'rows', 'columns'):
+            self.assertEqual(python_stats[key], stats[key])
+
+        self.layer.set_tile(0, 49, Tile(2, flags=TILEFLAG_HFLIP))
+        stats = self.layer.stats()
+        self.assertEqual(stats['histogram'], {0: 2473, 1: 26, 2: 1})
+        self.assertEqual(stats['flags'], {0: 26, TILEFLAG_HFLIP: 1})
+        self.assertEqual(stats['bbox'], (0, 0, 50, 50))
+
+        layer = TileLayer(3, 2)
+        self.assertEqual(layer.stats()['bbox'], None)
+        self.assertEqual(layer.stats()['fill'], 0.0)
+        self.assertEqual(layer._python_stats()['rows'], [0, 0])
+
+    def test_find_large_draw(self):
+        layer = TileLayer(100, 100)
+        layer.set_tile(99, 99, Tile(3))
+        self.assertEqual(layer.find('nohook'), [(99, 99)])
+        # large areas drop the index, it is built again when needed
+        layer.draw(0, 0, layer.select(1, 1, 99, 99))
+        self.assertEqual(layer._tile_index_cache, None)
+        self.assertEqual(layer.find('nohook'), [(98, 98), (99, 99)])
+
+    def test_tele_tiles(self):
+        layer = TileLayer(10, 10, game=2)
+        layer.tele_tiles[12] = '\x05\x1a'
+        layer.set_tile(2, 1, Tile(26))
+        selection = layer.select(1, 1, 3, 3)
+        self.assertEqual(len(selection.tele_tiles), 9)
+        self.assertEqual(selection.tele_tiles[1].number, 5)
+        self.assertEqual(selection.tiles[1].index, 26)
+
+        layer.draw(5, 5, selection)
+        self.assertEqual(layer.tele_tiles[56].number, 5)
+        self.assertEqual(layer.get_tile(6, 5).index, 26)
+
+        layer.width = 20
+        self.assertEqual(len(layer.tele_tiles), 200)
+        self.assertEqual(layer.tele_tiles[22].number, 5)
+        self.assertEqual(layer.tele_tiles[106].number, 5)
+        layer.height = 6
+        self.assertEqual(len(layer.tele_tiles), 120)
+        self.assertEqual(layer.tele_tiles[106].number, 5)
+        self.assertEqual(layer.get_tile(6, 5).index, 26)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_as_array(self):
+        array = self.layer.as_array()
+        self.assertEqual(array.shape, (50, 50))
+        self.assertEqual(array[0, 20]['index'], 1)
+        self.assertEqual(array[1, 20]['index'], 1)
+        self.assertEqual(array['index'].sum(), 26)
+        array[3, 4]['index'] = 9
+        self.assertEqual(self.layer.get_tile(4, 3).index, 9)
+        self.layer.set_tile(5, 3, Tile(7))
+        self.assertEqual(array[3, 5]['index'], 7)
+
+        self.layer.index_plane[10:12, 0] = 3
+        self.assertEqual(self.layer.get_tile(0, 10).index, 3)
+        self.assertEqual(self.layer.get_tile(0, 11).index, 3)
+        self.layer.flags_plane[0, 0] = 8
+        self.assertTrue(self.layer.get_tile(0, 0).flags['rotation'])
+
+        layer = TileLayer(5, 3)
+        self.assertEqual(layer.index_plane.shape, (3, 5))
+
 class TestTileManager(unittest.TestCase):
 
     def test_init(self):
-        pass
+        manager = TileManager(10)
+        self.assertEqual(len(manager), 10)
+        self.assertEqual(manager.data, bytearray(40))
+        manager = TileManager(tiles=[Tile(1), Tile(2, flags=8)])
+        self.assertEqual(len(manager), 2)
+        self.assertEqual(manager.data, bytearray('\x01\x00\x00\x00'
+                                                 '\x02\x08\x00\x00'))
+        data = bytearray(8)
+        self.assertIs(TileManager(data=data).data, data)
+        self.assertEqual(len(TileManager(data='\x00' * 8, _type=1)), 4)
+
+    def test_getitem(self):
+        manager = TileManager(tiles=[Tile(i) for i in range(10)])
+        self.assertEqual(manager[3], Tile(3))
+        self.assertEqual(manager[-1], Tile(9))
+        self.assertRaises(IndexError, manager.__getitem__, 10)
+        self.assertEqual(list(manager[2:5]), [Tile(2), Tile(3), Tile(4)])
+        self.assertEqual(list(manager[::4]), [Tile(0), Tile(4), Tile(8)])
+        self.assertEqual(len(manager[8:2]), 0)
+
+    def test_setitem(self):
+        manager = TileManager(5)
+        manager[1] = Tile(7, flags=2)
+        self.assertEqual(manager[1], Tile(7, flags=2))
+        manager[-1] = '\x05\x00\x00\x00'
+        self.assertEqual(manager[4].index, 5)
+        self.assertRaises(ValueError, manager.__setitem__, 0, '\x05')
+        self.assertRaises(IndexError, manager.__setitem__, 5, Tile(1))
+        self.assertEqual(len(manager.data), 20)
+
+    def test_frozen(self):
+        manager = TileManager(tiles=[Tile(1, flags=8), Tile(2), Tile(1, flags=8)])
+        tile = manager.frozen(0)
+        self.assertIs(manager.frozen(2), tile)
+        self.assertIs(manager.frozen(-1), tile)
+        self.assertEqual(tile, Tile(1, flags=8))
+        self.assertTrue(tile.flags['rotation'])
+        self.assertRaises(AttributeError, setattr, tile, 'index', 3)
+        self.assertRaises(AttributeError, tile.rotate, 'r')
+        self.assertRaises(IndexError, manager.frozen, 3)
+        self.assertRaises(TypeError, TileManager(2, _type=1).frozen, 0)
+
+        copy = tile.copy()
+        self.assertIs(type(copy), Tile)
+        copy.rotate('r')
+        manager[0] = copy
+        self.assertEqual(manager[0], copy)
+        self.assertEqual(manager.frozen(2), Tile(1, flags=8))
+        self.assertFalse(hasattr(copy, '__dict__'))
+
+class TestColumnTileManager(unittest.TestCase):
+
+    def test_data(self):
+        data = '\x01\x00\x00\x00\x07\x00\x5a\x00\x02\x00\xa6\xff'
+        manager = SpeedupTileManager(data=data)
+        self.assertEqual(len(manager), 3)
+        self.assertEqual(list(manager.arrays['force']), [1, 7, 2])
+        self.assertEqual(list(manager.arrays['angle']), [0, 90, -90])
+        self.assertEqual(str(manager.data), data)
+        self.assertEqual(manager[2].angle, -90)
+        manager[0] = SpeedupTile(3, 180)
+        manager[1] = '\x04\x00\x0e\x01'
+        self.assertEqual(list(manager.arrays['force']), [3, 4, 2])
+        self.assertEqual(list(manager.arrays['angle']), [180, 270, -90])
+        self.assertRaises(IndexError, manager.__getitem__, 3)
+
+    def test_columns(self):
+        manager = TeleTileManager(6)
+        manager.set_column('number', range(6))
+        self.assertEqual(manager[4].number, 4)
+        self.assertEqual(list(manager.get_column('number')), range(6))
+        self.assertRaises(ValueError, manager.set_column, 'type', [1])
+        self.assertEqual(list(manager[1:5:2].arrays['number']), [1, 3])
+        region = manager.get_region(3, 1, 0, 2, 2)
+        self.assertEqual(list(region.arrays['number']), [1, 2, 4, 5])
+        manager.set_region(3, 0, 0, manager, 3, 1, 0, 2, 2)
+        self.assertEqual(list(manager.arrays['number']), [1, 2, 2, 4, 5, 5])
+        self.assertEqual(str(manager.data), '\x01\x00\x02\x00\x02\x00'
+                                            '\x04\x00\x05\x00\x05\x00')
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_as_array(self):
+        manager = SpeedupTileManager(4)
+        angles = manager.as_array('angle')
+        angles[1] = -45
+        self.assertEqual(manager[1].angle, -45)
+        self.assertEqual(sorted(manager.as_array()), ['angle', 'force'])
 
 class TestQuadLayer(unittest.TestCase):
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from struct import pack
+import unittest
+
+from constants import LAYERTYPE_TILES
+import schemas
+from utils import string_to_ints
+
+class TestSchema(unittest.TestCase):
+
+    def test_group_versions(self):
+        name = string_to_ints('Game', 3)
+        data = pack('15i', 3, 1, 2, 100, 100, 4, 2, 1, 0, 0, 10, 20, *name)
+        group = schemas.GROUP.decode(data)
+        self.assertEqual(group['offset_x'], 1)
+        self.assertEqual(group['num_layers'], 2)
+        self.assertEqual(group['clip_h'], 20)
+        self.assertEqual(group['name'], 'Game')
+        self.assertEqual(group['extra'], ())
+        self.assertEqual(schemas.GROUP.encode(group), data)
+
+        # the first version doesn't know clipping and names
+        group = schemas.GROUP.decode(pack('7i', 1, 1, 2, 100, 100, 4, 2))
+        self.assertEqual(group['use_clipping'], 0)
+        self.assertEqual(group['name'], None)
+        self.assertEqual(len(schemas.GROUP.encode(group)), 7*4)
+
+    def test_extra(self):
+        name = string_to_ints('Tele', 3)
+        data = pack('20i', 0, LAYERTYPE_TILES, 0, 3, 50, 40, 2, 255, 255, 255,
+                    255, -1, 0, -1, 5, name[0], name[1], name[2], 6, -1)
+        layer = schemas.TILELAYER.decode(data)
+        self.assertEqual(layer['color'], (255, 255, 255, 255))
+        self.assertEqual(layer['data'], 5)
+        self.assertEqual(layer['extra'], (6, -1))
+        self.assertEqual(schemas.TILELAYER.encode(layer, layer['extra']), data)
+
+        # old layers have the extra ints right after the data
+        data = pack('17i', 0, LAYERTYPE_TILES, 0, 2, 50, 40, 2, 255, 255, 255,
+                    255, -1, 0, -1, 5, 6, -1)
+        layer = schemas.TILELAYER.decode(data)
+        self.assertEqual(layer['name'], None)
+        self.assertEqual(layer['extra'], (6, -1))
+
+    def test_array(self):
+        data = pack('12i', 0, 1, 2, 3, 4, 5, 10, 0, 6, 7, 8, 9)
+        points = list(schemas.ENVPOINT.iter_decode(data))
+        self.assertEqual(len(points), 2)
+        self.assertEqual(points[1]['time'], 10)
+        self.assertEqual(points[1]['values'], (6, 7, 8, 9))
+        self.assertEqual(schemas.ENVPOINT.encode_all(points), data)
+
+    def test_defaults(self):
+        # old maps have no settings
+        info = schemas.INFO.decode(pack('5i', 1, 2, 3, 4, 5))
+        self.assertEqual(info['settings'], -1)
+        self.assertEqual(info['license'], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import filecmp
+from io import BytesIO
 import os
 import shutil
 import unittest
 import warnings
 
+from struct import pack
+from zlib import compress
+
+import datafile
+from datafile import DataFileReader, DataFileWriter
+from constants import TILEINDEX
 from tml import Teemap, MapError
 import items
+from utils import data_key
 
 class TestTeemap(unittest.TestCase):
 
@@ -67,6 +75,65 @@ class TestTeemap(unittest.TestCase):
 
         self.assertIs(self.teemap.layers[3], self.teemap.gamelayer)
 
+    def test_layer_index(self):
+        teemap = self.teemap
+        self.assertEqual(len(teemap.tilelayers), 4)
+        self.assertEqual(len(teemap.quadlayers), 2)
+        self.assertIs(teemap._index(), teemap._index())
+        self.assertIsNone(teemap.telelayer)
+
+        layer = items.TileLayer(game=2)
+        teemap.groups[3].append(layer)
+        self.assertIs(teemap.layers[4], layer)
+        self.assertIs(teemap.telelayer, layer)
+        layer.game = 0
+        self.assertIsNone(teemap.telelayer)
+        teemap.groups[3].layers = []
+        self.assertEqual(len(teemap.layers), 6)
+
+        gamelayer = teemap.gamelayer
+        teemap.groups.insert(0, items.Group(layers=[items.TileLayer(game=1)]))
+        self.assertRaises(MapError, lambda: teemap.gamelayer)
+        del teemap.groups[0]
+        self.assertIs(teemap.gamelayer, gamelayer)
+        teemap.groups[2:3] = []
+        self.assertRaises(MapError, lambda: teemap.gamelayer)
+
+        # assigned lists are used as they are
+        layers = []
+        teemap.groups[0].layers = layers
+        teemap.groups[0].layers.append(items.TileLayer(game=2))
+        self.assertIs(teemap.telelayer, layers[0])
+        # other maps and new layers don't touch the index
+        index = teemap._index()
+        Teemap('tml/test_maps/vanilla').groups.append(items.Group())
+        items.TileLayer(game=1)
+        self.assertIs(teemap._index(), index)
+
+    def test_layer_index_cached(self):
+        class CountingList(list):
+            iterations = 0
+            def __iter__(self):
+                CountingList.iterations += 1
+                return list.__iter__(self)
+
+        teemap = self.teemap
+        groups = CountingList(teemap.groups)
+        teemap.groups = groups
+        teemap.width
+        iterations = CountingList.iterations
+        for i in range(10):
+            teemap.width
+            teemap.telelayer
+            teemap.layers
+        # nothing is rebuilt on repeated access
+        self.assertEqual(CountingList.iterations, iterations)
+        teemap.groups.append(items.Group(layers=[items.TileLayer(game=4)]))
+        self.assertIs(teemap.speeduplayer, groups[-1].layers[0])
+        self.assertEqual(CountingList.iterations, iterations + 1)
+        teemap.groups[-1].layers[0].game = 0
+        self.assertIsNone(teemap.speeduplayer)
+
     def test_envelopes(self):
         self.assertEqual(len(self.teemap.envelopes), 2)
         self.assertEqual(self.teemap.envelopes[0].name, 'PosEnv')
@@ -211,6 +278,80 @@ class TestTeemap(unittest.TestCase):
             self.assertEqual(envpoint.curvetype, curvetypes[i])
             self.assertEqual(envpoint.values, values[i])
 
+    def test_lazy_load(self):
+        teemap = Teemap('tml/test_maps/vanilla', lazy=True)
+        layer = teemap.layers[2]
+        self.assertTrue(isinstance(layer._tiles, items.LazyData))
+        self.assertTrue(isinstance(teemap.layers[0]._quads, items.LazyData))
+        self.assertTrue(isinstance(teemap.images[1]._data, items.LazyData))
+        self.assertEqual(len(layer.tiles), 15)
+        self.assertTrue(isinstance(layer._tiles, items.TileManager))
+        self.assertEqual(list(layer.tiles), list(self.teemap.layers[2].tiles))
+        self.assertEqual(list(teemap.layers[1].quads),
+                         list(self.teemap.layers[1].quads))
+        self.assertEqual(teemap.images[1].data, self.teemap.images[1].data)
+        teemap.save('test_tmp/lazy.map')
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/lazy.map'))
+
+    def test_from_bytes(self):
+        with open('tml/test_maps/vanilla.map', 'rb') as f:
+            vanilla = f.read()
+        for data in (vanilla, bytearray(vanilla), buffer(vanilla),
+                     memoryview(vanilla)):
+            teemap = Teemap.from_bytes(data, lazy=True)
+            self.assertEqual(len(teemap.layers), 6)
+            self.assertEqual(teemap.layers[2].tiles.data,
+                             self.teemap.layers[2].tiles.data)
+            f = BytesIO()
+            teemap.save(f)
+            self.assertEqual(f.getvalue(), vanilla)
+
+    def test_from_file(self):
+        with open('tml/test_maps/vanilla.map', 'rb') as f:
+            vanilla = f.read()
+        teemap = Teemap.from_file(BytesIO(vanilla))
+        self.assertEqual(teemap.images[1].data, self.teemap.images[1].data)
+        with open('test_tmp/embedded', 'wb') as f:
+            f.write('header')
+            f.write(vanilla)
+        with open('test_tmp/embedded', 'rb') as f:
+            f.seek(6)
+            teemap = Teemap.from_file(f, lazy=True)
+        self.assertEqual(len(teemap.layers[5].tiles), 2500)
+        self.assertEqual(repr(teemap), '<Teemap (new)>')
+        self.assertEqual(repr(self.teemap), '<Teemap (vanilla)>')
+
+    def test_close(self):
+        shutil.copyfile('tml/test_maps/vanilla.map', 'test_tmp/close.map')
+        with Teemap('test_tmp/close', lazy=True) as teemap:
+            self.assertEqual(teemap.layers[5].tiles[0].index, 0)
+        self.assertEqual(teemap._mapping, None)
+        # nothing is read from the file anymore
+        os.remove('test_tmp/close.map')
+        self.assertEqual(len(teemap.images[1].data), 1024*1024*4)
+        teemap.save('test_tmp/copy')
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/copy.map', shallow=False))
+
+        # maps which are not lazy don't keep their file open
+        teemap = Teemap('test_tmp/copy')
+        self.assertEqual(teemap._mapping, None)
+        self.assertFalse(datafile._mappings.get(
+            os.path.realpath('test_tmp/copy.map')))
+        os.remove('test_tmp/copy.map')
+        teemap.save('test_tmp/copy')
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/copy.map', shallow=False))
+
+        # saving a map to its own file closes it first
+        teemap = Teemap('test_tmp/copy', lazy=True)
+        teemap.save('test_tmp/copy')
+        self.assertEqual(teemap._mapping, None)
+        self.assertEqual(teemap.layers[5].tiles[0].index, 0)
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/copy.map', shallow=False))
+
     def test_save(self):
         self.teemap.save('test_tmp/copy.map')
         self.teemap.save('test_tmp/copy2')
@@ -218,6 +359,272 @@ class TestTeemap(unittest.TestCase):
                                     'test_tmp/copy.map'))
         self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
                                     'test_tmp/copy2.map'))
+
+    @unittest.skipIf(not hasattr(os, 'symlink'), 'no symlinks')
+    def test_save_symlink(self):
+        os.mkdir('test_tmp/real')
+        shutil.copyfile('tml/test_maps/vanilla.map', 'test_tmp/real/m.map')
+        os.symlink(os.path.join('real', 'm.map'), 'test_tmp/m.map')
+        teemap = Teemap('test_tmp/m')
+        teemap.gamelayer.set_tile(0, 0, items.Tile(1))
+        teemap.save('test_tmp/m')
+        self.assertTrue(os.path.islink('test_tmp/m.map'))
+        saved = Teemap('test_tmp/real/m')
+        self.assertEqual(saved.gamelayer.get_tile(0, 0).index, 1)
+
+    def test_save_mode(self):
+        # new files get the usual mode, existing files keep theirs
+        self.teemap.save('test_tmp/mode')
+        self.assertEqual(os.stat('test_tmp/mode.map').st_mode & 0777,
+                         datafile._NEW_FILE_MODE)
+        os.chmod('test_tmp/mode.map', 0640)
+        self.teemap.save('test_tmp/mode')
+        self.assertEqual(os.stat('test_tmp/mode.map').st_mode & 0777, 0640)
+
+    def test_save_workers(self):
+        self.teemap.save('test_tmp/workers.map', workers=4)
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/workers.map'))
+
+    def test_save_file_object(self):
+        with open('tml/test_maps/vanilla.map', 'rb') as f:
+            vanilla = f.read()
+        f = BytesIO()
+        f.write('prefix')
+        self.teemap.save(f)
+        self.assertEqual(f.getvalue(), 'prefix' + vanilla)
+
+        class Stream(object):
+            """Not seekable, like a socket."""
+            def __init__(self):
+                self.chunks = []
+            def write(self, data):
+                self.chunks.append(str(data))
+        stream = Stream()
+        self.teemap.save(stream, workers=2)
+        self.assertEqual(''.join(stream.chunks), vanilla)
+
+    def test_save_unchanged_data(self):
+        # lazy data which was never accessed is passed through
+        shutil.copyfile('tml/test_maps/vanilla.map', 'test_tmp/lazy.map')
+        teemap = Teemap('test_tmp/lazy', lazy=True)
+        teemap.gamelayer.set_tile(0, 0, items.Tile(1))
+        teemap.save('test_tmp/lazy.map')
+        self.assertTrue(isinstance(items.peek(teemap.layers[5], 'tiles'),
+                                   items.LazyData))
+        self.assertTrue(isinstance(items.peek(teemap.images[1], 'data'),
+                                   items.LazyData))
+        original = DataFileReader('tml/test_maps/vanilla')
+        saved = DataFileReader('test_tmp/lazy')
+        changed = []
+        for i in range(original.header.num_raw_data):
+            if str(original.get_compressed_data(i)) != \
+               str(saved.get_compressed_data(i)):
+                changed.append(i)
+        self.assertEqual(changed, [7])
+        self.assertEqual(saved.groups[2].layers[0].get_tile(0, 0).index, 1)
+
+        # loaded data is taken from the old file if it's unchanged
+        layer = self.teemap.layers[5]
+        compressed = compress(str(layer.tiles.data), 1)
+        self.teemap._blocks[data_key(layer.tiles.data)] = compressed
+        self.teemap.save('test_tmp/blocks.map')
+        saved = DataFileReader('test_tmp/blocks')
+        self.assertEqual(str(saved.get_compressed_data(9)), compressed)
+        layer.set_tile(0, 0, items.Tile(3))
+        self.teemap.save('test_tmp/blocks.map')
+        saved = DataFileReader('test_tmp/blocks')
+        self.assertNotEqual(str(saved.get_compressed_data(9)), compressed)
+        self.assertEqual(saved.groups[4].layers[1].get_tile(0, 0).index, 3)
+
+    def test_save_shared_data(self):
+        # identical data parts are only saved once
+        teemap = Teemap('tml/test_maps/vanilla')
+        gamelayer = teemap.gamelayer
+        for i in range(2):
+            layer = gamelayer.select(0, 0, gamelayer.width, gamelayer.height)
+            layer.game = 0
+            teemap.groups[2].layers.append(layer)
+        teemap.save('test_tmp/shared')
+        original = DataFileReader('tml/test_maps/vanilla')
+        saved = DataFileReader('test_tmp/shared')
+        # the gamelayer keeps its own data part
+        self.assertEqual(saved.header.num_raw_data,
+                         original.header.num_raw_data + 1)
+        layers = saved.groups[2].layers
+        self.assertEqual(len(layers), 3)
+        for layer in layers[1:]:
+            self.assertEqual(layer.tiles.data, gamelayer.tiles.data)
+
+    def test_save_compression(self):
+        sizes = {}
+        for compression in ('fast', 'default', 'max'):
+            teemap = Teemap('tml/test_maps/vanilla')
+            teemap.save('test_tmp/{0}'.format(compression),
+                        compression=compression)
+            sizes[compression] = os.path.getsize(
+                'test_tmp/{0}.map'.format(compression))
+            saved = Teemap('test_tmp/{0}'.format(compression))
+            self.assertEqual(saved.layers[5].tiles.data,
+                             teemap.layers[5].tiles.data)
+            self.assertEqual(saved.images[1].data, teemap.images[1].data)
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/default.map'))
+        self.assertTrue(sizes['max'] <= sizes['default'])
+        self.assertRaises(ValueError, teemap.save, 'test_tmp/invalid',
+                          compression='invalid')
+
+    def test_save_incremental(self):
+        shutil.copyfile('tml/test_maps/vanilla.map', 'test_tmp/patch.map')
+        teemap = Teemap('test_tmp/patch', lazy=True)
+        teemap.gamelayer.set_tile(0, 0, items.Tile(1))
+        writer = DataFileWriter(teemap, 'test_tmp/patch', incremental=True)
+        self.assertTrue(writer.patched)
+        teemap.save('test_tmp/full')
+        self.assertTrue(filecmp.cmp('test_tmp/patch.map', 'test_tmp/full.map',
+                                    shallow=False))
+        # data which was not loaded yet is still valid
+        self.assertEqual(teemap.layers[5].tiles[0].index, 0)
+        self.assertEqual(len(teemap.images[1].data), 1024*1024*4)
+
+        # new items move all data parts, so the whole file is written
+        teemap.groups.append(items.Group())
+        writer = DataFileWriter(teemap, 'test_tmp/patch', incremental=True)
+        self.assertFalse(writer.patched)
+        self.assertEqual(len(Teemap('test_tmp/patch').groups),
+                         len(teemap.groups))
+
+    def test_save_incremental_shared(self):
+        # layers sharing a data part keep their data when the file changes
+        gamelayer = self.teemap.gamelayer
+        for i in range(2):
+            layer = gamelayer.select(0, 0, gamelayer.width, gamelayer.height)
+            layer.game = 0
+            self.teemap.groups[2].layers.append(layer)
+        # saved with 'max', so saving with 'max' again can patch the file
+        self.teemap.save('test_tmp/shared', compression='max')
+        for compression in ('default', 'max'):
+            teemap = Teemap('test_tmp/shared', lazy=True)
+            teemap.gamelayer.set_tile(0, 0, items.Tile(2))
+            writer = DataFileWriter(teemap, 'test_tmp/shared',
+                                    compression=compression, incremental=True)
+            self.assertTrue(writer.patched)
+            for layer in teemap.groups[2].layers[1:]:
+                self.assertEqual(layer.tiles.data, gamelayer.tiles.data)
+            teemap.save('test_tmp/full')
+            saved = Teemap('test_tmp/full')
+            self.assertEqual(saved.gamelayer.get_tile(0, 0).index, 2)
+            self.assertEqual(saved.groups[2].layers[2].tiles.data,
+                             gamelayer.tiles.data)
+
+    def test_save_incremental_mapped(self):
+        # maps which still read from the file are not patched under them
+        shutil.copyfile('tml/test_maps/vanilla.map', 'test_tmp/mapped.map')
+        other = Teemap('test_tmp/mapped', lazy=True)
+        teemap = Teemap('test_tmp/mapped', lazy=True)
+        teemap.gamelayer.set_tile(0, 0, items.Tile(1))
+        teemap.groups[2].layers[0].width = 10
+        writer = DataFileWriter(teemap, 'test_tmp/mapped', incremental=True)
+        self.assertFalse(writer.patched)
+        other.save('test_tmp/other')
+        self.assertTrue(filecmp.cmp('tml/test_maps/vanilla.map',
+                                    'test_tmp/other.map', shallow=False))
+        self.assertEqual(Teemap('test_tmp/mapped').gamelayer.width, 10)
+
+        other.close()
+        teemap.gamelayer.set_tile(0, 0, items.Tile(3))
+        writer = DataFileWriter(teemap, 'test_tmp/mapped', incremental=True)
+        self.assertTrue(writer.patched)
+
+    def test_entities(self):
+        teemap = Teemap('tml/test_maps/vanilla')
+        entities = teemap.entities()
+        self.assertFalse('air' in entities)
+        self.assertFalse('solid' in entities)
+        teemap.gamelayer.set_tile(2, 3, items.Tile(TILEINDEX['spawn']))
+        self.assertEqual(teemap.entities()['spawn'],
+                         sorted(entities['spawn'] + [(2, 3)],
+                                key=lambda (x, y): (y, x)))
+
+    def test_stats(self):
+        teemap = Teemap('tml/test_maps/vanilla')
+        stats = teemap.stats()
+        self.assertEqual([layer for layer, _ in stats], teemap.tilelayers)
+        gamelayer = teemap.gamelayer
+        game_stats = dict(stats)[gamelayer]
+        self.assertEqual(sum(game_stats['histogram'].values()),
+                         gamelayer.width * gamelayer.height)
+        self.assertEqual(game_stats['histogram'][TILEINDEX['spawn']],
+                         len(teemap.entities()['spawn']))
+
+    def test_fingerprint(self):
+        teemap = Teemap('tml/test_maps/vanilla')
+        fingerprint = teemap.fingerprint()
+        layer_fingerprint = teemap.layers[5].fingerprint()
+        # compression and lazy loading don't change the fingerprint
+        teemap.save('test_tmp/fingerprint', compression='fast')
+        lazy = Teemap('test_tmp/fingerprint', lazy=True)
+        self.assertEqual(lazy.fingerprint(), fingerprint)
+        self.assertEqual(lazy.layers[5].fingerprint(), layer_fingerprint)
+        self.assertTrue(isinstance(items.peek(lazy.layers[5], 'tiles'),
+                                   items.LazyData))
+        teemap.layers[5].set_tile(0, 0, items.Tile(1))
+        self.assertNotEqual(teemap.layers[5].fingerprint(), layer_fingerprint)
+        self.assertNotEqual(teemap.fingerprint(), fingerprint)
+
+        # the file gives the same fingerprint without loading the map
+        self.assertEqual(datafile.fingerprint('tml/test_maps/vanilla'),
+                         fingerprint)
+        teemap.save('test_tmp/changed')
+        self.assertEqual(datafile.fingerprint('test_tmp/changed'),
+                         teemap.fingerprint())
+        teemap = Teemap()
+        group = items.Group(layers=[items.TileLayer(game=1),
+                                    items.TileLayer(game=2),
+                                    items.TileLayer(game=4),
+                                    items.QuadLayer(name='Quads')])
+        teemap.groups.append(group)
+        group.layers[3].quads.append(items.Quad())
+        teemap.save('test_tmp/race')
+        self.assertEqual(datafile.fingerprint('test_tmp/race'),
+                         teemap.fingerprint())
+
+    def test_unknown_items(self):
+        teemap = Teemap('tml/test_maps/vanilla')
+        teemap.unknown_items[(0x8000, 1)] = pack('2i', 3, 12)
+        teemap.unknown_datas[3] = 'modification data'
+        teemap.unknown_datas[12] = 'more data'
+        teemap.layers[5].extra = (3,)
+        teemap.save('test_tmp/unknown')
+
+        saved = Teemap('test_tmp/unknown', lazy=True)
+        self.assertEqual(saved.unknown_items, {(0x8000, 1): pack('2i', 3, 12)})
+        self.assertEqual(saved.unknown_datas[3].raw(), 'modification data')
+        self.assertEqual(saved.unknown_datas[12].raw(), 'more data')
+        self.assertEqual(saved.layers[5].extra, (3,))
+        self.assertEqual(saved.fingerprint(), teemap.fingerprint())
+        self.assertEqual(datafile.fingerprint('test_tmp/unknown'),
+                         teemap.fingerprint())
+        # the fingerprints depend on the data of modifications
+        fingerprint = saved.fingerprint()
+        layer_fingerprint = saved.layers[5].fingerprint()
+        saved.unknown_datas[12] = 'other data'
+        self.assertNotEqual(saved.fingerprint(), fingerprint)
+        saved.unknown_datas[12] = 'more data'
+        saved.unknown_items[(0x8000, 1)] = pack('2i', 12, 3)
+        self.assertNotEqual(saved.fingerprint(), fingerprint)
+        saved.unknown_items[(0x8000, 1)] = pack('2i', 3, 12)
+        self.assertEqual(saved.fingerprint(), fingerprint)
+        saved.layers[5].extra = (12,)
+        self.assertNotEqual(saved.layers[5].fingerprint(), layer_fingerprint)
+        self.assertNotEqual(saved.fingerprint(), fingerprint)
+        saved.layers[5].extra = (3,)
+
+        # saving again keeps everything where it is
+        saved.save('test_tmp/unknown2')
+        self.assertTrue(filecmp.cmp('test_tmp/unknown.map',
+                                    'test_tmp/unknown2.map', shallow=False))
+
     def test_validate(self):
         teemap = Teemap()
         self.assertRaises(MapError, teemap.validate)
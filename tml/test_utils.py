@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from hashlib import sha1
 import unittest
 
-from utils import ints_to_string, string_to_ints
+from utils import data_key, ints_to_string, string_to_ints
 
 TEST_INT = [-186256396, -2139062144, -2139062144, -2139062144, -2139062144,
             -2139062144, -2139062144, -2139062272]
@@ -15,3 +16,8 @@ class TestUtils(unittest.TestCase):
     def test_string_to_ints(self):
         test = string_to_ints('test')
         self.assertEqual(test, TEST_INT)
+
+    def test_data_key(self):
+        self.assertEqual(data_key(bytearray('tiles')), data_key('tiles'))
+        self.assertEqual(data_key(buffer('xtiles', 1)), data_key('tiles'))
+        self.assertEqual(data_key('tiles'), (5, sha1('tiles').digest()))
@@ -9,7 +9,9 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 from constants import *
-from datafile import DataFileReader, DataFileWriter
+from datafile import DataFileReader, DataFileWriter, crc, fingerprint, \
+     scan
+import items
 
 class MapError(BaseException):
     """Raised when your map is not a valid teeworlds map.
@@ -27,13 +29,29 @@ class Teemap(object):
     All information about the map can be accessed through this class.
 
     :param map_path: Path to the teeworlds mapfile.
+    :param lazy: If ``True``, tiles, quads and embedded images are decoded
+                 on first access instead of while loading the map.
+    :param workers: Number of threads used to decompress the map.
+
+    A lazy map reads from its memory-mapped file as long as it is open. It
+    can be used as context manager, which closes the file at the end, see
+    :meth:`close`. Other maps close the file right after loading.
     """
 
-    def __init__(self, map_path=None):
+    def __init__(self, map_path=None, lazy=False, workers=1):
         self.name = ''
+        self._layer_index = None
+        # increased on every change of the groups, layers or layer roles
+        self._revision = 0
+        self._mapping = None
+        self._blocks = {}
+        # items of unknown types by type and id, and the data parts they
+        # reference by index, which are saved as they are
+        self.unknown_items = {}
+        self.unknown_datas = {}
 
         if map_path:
-            self._load(map_path)
+            self._load(map_path, lazy, workers)
         else:
             # default item types
             for type_ in ITEM_TYPES:
@@ -41,13 +59,65 @@ class Teemap(object):
                     setattr(self, ''.join([type_, 's']), [])
             self.info = None
 
+    @property
+    def groups(self):
+        return self._groups
+
+    @groups.setter
+    def groups(self, groups):
+        self._groups = items._item_list(groups, self)
+        self._changed()
+
+    def _changed(self):
+        self._revision += 1
+
+    def _index(self):
+        """Returns the index of the layers by their role and type.
+
+        The index is kept until the groups or layers of the map change or a
+        layer gets another role, which :class:`ItemList
+        <tml.items.ItemList>` and :class:`TileLayer <tml.items.TileLayer>`
+        report to the map.
+        """
+        if self._layer_index is None or \
+           self._layer_index['revision'] != self._revision:
+            layers = []
+            for group in self.groups:
+                items._add_map(group, self)
+                layers.extend(group.layers)
+            for layer in layers:
+                items._add_map(layer, self)
+            tilelayers = [layer for layer in layers
+                          if isinstance(layer, items.TileLayer)]
+            self._layer_index = {
+                'revision': self._revision,
+                'layers': layers,
+                'tilelayers': tilelayers,
+                'quadlayers': [layer for layer in layers
+                               if isinstance(layer, items.QuadLayer)],
+                'gamelayers': [layer for layer in tilelayers
+                               if layer.is_gamelayer],
+                'telelayers': [layer for layer in tilelayers
+                               if layer.is_telelayer],
+                'speeduplayers': [layer for layer in tilelayers
+                                  if layer.is_speeduplayer],
+            }
+        return self._layer_index
+
     @property
     def layers(self):
         """Returns a list of all layers, collected from the groups."""
-        layers = []
-        for group in self.groups:
-            layers.extend(group.layers)
-        return layers
+        return list(self._index()['layers'])
+
+    @property
+    def tilelayers(self):
+        """Returns a list of all tilelayers."""
+        return list(self._index()['tilelayers'])
+
+    @property
+    def quadlayers(self):
+        """Returns a list of all quadlayers."""
+        return list(self._index()['quadlayers'])
 
     @property
     def gamelayer(self):
@@ -57,30 +127,26 @@ class Teemap(object):
         the first one
 
         """
-        i = 0
-        for layer in self.layers:
-            if layer.is_gamelayer:
-                gamelayer = layer
-                i += 1
-        if i < 1:
+        gamelayers = self._index()['gamelayers']
+        if len(gamelayers) < 1:
             raise MapError('There is no gamelayer')
-        elif i > 1:
+        elif len(gamelayers) > 1:
             raise MapError('There is more than one gamelayer')
-        return gamelayer
+        return gamelayers[0]
 
     @property
     def telelayer(self):
         """Returns the telelayer. Only for race modification."""
-        for layer in self.layers:
-            if layer.is_telelayer:
-                return layer
+        telelayers = self._index()['telelayers']
+        if telelayers:
+            return telelayers[0]
 
     @property
     def speeduplayer(self):
         """Returns the speeduplayer. Only for race modification."""
-        for layer in self.layers:
-            if layer.is_speeduplayer:
-                return layer
+        speeduplayers = self._index()['speeduplayers']
+        if speeduplayers:
+            return speeduplayers[0]
 
     @property
     def width(self):
@@ -90,6 +156,72 @@ class Teemap(object):
     def height(self):
         return self.gamelayer.height
 
+    def entities(self):
+        """Returns the positions of the entities and special tiles.
+
+        Uses the tile index of the gamelayer, see :meth:`TileLayer.find
+        <tml.items.TileLayer.find>`.
+
+        :returns: dict mapping the names in :data:`TILEINDEX
+                  <tml.constants.TILEINDEX>` except air and solid to lists
+                  of ``(x, y)``
+        """
+        gamelayer = self.gamelayer
+        return dict([(name, gamelayer.find(index))
+                     for name, index in TILEINDEX.items() if index > 1])
+
+    def stats(self):
+        """Returns the statistics of all tilelayers.
+
+        See :meth:`TileLayer.stats <tml.items.TileLayer.stats>`, they are
+        cached per layer.
+
+        :returns: list of ``(layer, stats)`` in the order of :attr:`layers`
+        """
+        return [(layer, layer.stats()) for layer in self.tilelayers]
+
+    def fingerprint(self):
+        """Returns a hash of the content of the map.
+
+        Maps with the same content have the same fingerprint, no matter how
+        they were compressed. Lazy tiles, quads and images are decompressed
+        for it, but not decoded. See :meth:`TileLayer.fingerprint
+        <tml.items.TileLayer.fingerprint>` for the hashes of single layers.
+        :func:`fingerprint <tml.datafile.fingerprint>` computes the same hash
+        from the file of a map without loading it.
+        """
+        info = self.info or items.Info()
+        values = [(info.author, info.map_version, info.credits, info.license,
+                   tuple(info.settings or ()))]
+        datas = []
+        for image in self.images:
+            values.append((image.name, image.width, image.height,
+                           bool(image.external)))
+            datas.append(items.peek_raw(image, 'data', str))
+        for envelope in self.envelopes:
+            values.append((envelope.name or '', envelope.channels,
+                           len(envelope.envpoints)))
+        for envpoint in self.envpoints:
+            values.append((envpoint.time, envpoint.curvetype,
+                           tuple(envpoint.values)))
+        for group in self.groups:
+            values.append((group.name or '', group.offset_x, group.offset_y,
+                           group.parallax_x, group.parallax_y,
+                           group.use_clipping, group.clip_x, group.clip_y,
+                           group.clip_w, group.clip_h,
+                           [layer.fingerprint() for layer in group.layers]))
+        # e.g. extension items and data of modifications
+        for key, data in sorted(self.unknown_items.items()):
+            values.append((key, data))
+        for index, data in sorted(self.unknown_datas.items()):
+            if isinstance(data, items.LazyData):
+                data = data.raw()
+            # empty data parts only fill gaps before reserved indices
+            if data:
+                values.append(index)
+                datas.append(data)
+        return items.fingerprint(values, datas)
+
     def validate(self):
         """Check if the map is a valid teeworlds map.
 
@@ -99,7 +231,7 @@ class Teemap(object):
         gamelayers = 0
         for layer in self.layers:
             if layer.type == 'tilelayer':
-                if len(layer.tiles) != layer.width * layer.height:
+                if layer._num_tiles() != layer.width * layer.height:
                     raise LayerError('Layer width and height does not fit to '
                                      'the number of tiles')
             if layer.is_gamelayer:
@@ -108,26 +240,117 @@ class Teemap(object):
             raise MapError('This map contains no gamelayer.')
         if gamelayers > 1:
             raise MapError('This map contains {0} gamelayers.'.format(gamelayers))
-        if len(self.gamelayer.tiles) == 0:
+        if self.gamelayer._num_tiles() == 0:
             raise MapError('The gamelayer does not contain any tiles')
 
         return True
 
-    def _load(self, map_path):
+    @classmethod
+    def from_bytes(cls, data, lazy=False, workers=1):
+        """Loads a map from its content instead of a file.
+
+        :param data: String, bytearray, buffer or memoryview with the map.
+        """
+        teemap = cls()
+        teemap._load_datafile(DataFileReader(data=data, lazy=lazy,
+                                             workers=workers))
+        return teemap
+
+    @classmethod
+    def from_file(cls, f, lazy=False, workers=1):
+        """Loads a map from a file-like object.
+
+        Real files are memory-mapped from their current position, other
+        objects are read until the end.
+        """
+        teemap = cls()
+        teemap._load_datafile(DataFileReader(f, lazy=lazy, workers=workers))
+        return teemap
+
+    def _load(self, map_path, lazy=False, workers=1):
         """Load a new teeworlds map from `map_path`.
 
         Should only be called by __init__.
         """
-        datafile = DataFileReader(map_path)
+        self._load_datafile(DataFileReader(map_path, lazy=lazy,
+                                           workers=workers))
+
+    def _load_datafile(self, datafile):
+        """Takes over the items of a :class:`DataFileReader`."""
+        self.name = datafile.name
         self.envelopes = datafile.envelopes
         self.envpoints = datafile.envpoints
         self.groups = datafile.groups
         self.images = datafile.images
         self.info = datafile.info
+        # compressed data parts of the file, reused on save if unchanged
+        self._blocks = datafile.blocks
+        self._mapping = datafile._mapping
+        self.unknown_items = datafile.unknown_items
+        self.unknown_datas = datafile.unknown_datas
+        # everything else is decoded already, so the file doesn't need to
+        # stay open and take a file descriptor as long as the map lives
+        if not datafile.lazy:
+            self.close()
+
+    def _lazy_datas(self):
+        """Yields all :class:`LazyData <tml.items.LazyData>` of the map."""
+        for obj in self.images + self.layers:
+            for value in obj.__dict__.values():
+                if isinstance(value, items.LazyData):
+                    yield value
+        for value in self.unknown_datas.values():
+            if isinstance(value, items.LazyData):
+                yield value
+
+    def close(self):
+        """Closes the memory-mapped file the map was loaded from.
+
+        The compressed data still read from the file, e.g. of lazy tiles
+        which were not accessed yet, is copied into memory first, so the map
+        stays usable. Afterwards the file can be replaced or removed, which
+        Windows doesn't allow while it is mapped. Saving the map to its own
+        file closes it as well.
+        """
+        if self._mapping is None:
+            return
+        for lazy in self._lazy_datas():
+            if not isinstance(lazy.data, str):
+                lazy.data = str(lazy.data)
+        for key, data in self._blocks.items():
+            self._blocks[key] = str(data)
+        self._mapping.close()
+        self._mapping = None
 
-    def save(self, map_path):
-        """Saves the current map to `map_path`."""
-        DataFileWriter(self, map_path)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self, map_path, workers=1, compression='default',
+             incremental=False):
+        """Saves the current map to `map_path`.
+
+        The map is written to a temporary file next to the target, which
+        then replaces it, so the directory must be writable. If `map_path`
+        is a symlink, the file it points to is replaced.
+
+        :param map_path: Path or a writable file-like object.
+        :param workers: Number of threads used to compress the map.
+        :param compression: ``'fast'`` saves quickly with larger data parts,
+                            ``'max'`` compresses every data part again as
+                            small as possible. Maps saved with any profile
+                            load in the client.
+        :param incremental: If ``True`` and `map_path` exists, only the
+                            changed parts of the file are written if
+                            possible. It is not possible while other open
+                            maps or readers have the file mapped, see
+                            :meth:`DataFileWriter.patch
+                            <tml.datafile.DataFileWriter.patch>`.
+        """
+        DataFileWriter(self, map_path, workers=workers,
+                       compression=compression, incremental=incremental)
 
     def _create_default(self):
         """Creates the default map.
@@ -6,6 +6,7 @@
     :copyright: 2010-2011 by the TML Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+from hashlib import sha1
 
 def int32(x):
     if x>0xFFFFFFFF:
@@ -39,4 +40,13 @@ def string_to_ints(in_string, length=8):
                 string += chr(0)
         ints.append(int32(((ord(string[0])+128)<<24)|((ord(string[1])+128)<<16)|((ord(string[2])+128)<<8)|(ord(string[3])+128)))
     ints[-1] &= int32(0xffffff00)
-    return ints
\ No newline at end of file
+    return ints
+
+def data_key(data):
+    """Returns a key identifying the content of an uncompressed data part.
+
+    Saving reuses the compressed data of a loaded data part with the same
+    key without comparing the content, so the key is a SHA-1 digest.
+    """
+    data = buffer(data)
+    return (len(data), sha1(data).digest())